@@ -0,0 +1,195 @@
+"""End to end sending benchmark against local fake GCM and APNS servers.
+
+Run from the project's root::
+
+    python -m benchmarks.run --devices 10000 100000 1000000
+
+Every size runs in its own process against a fresh database, sending a
+notification to all devices with create_push_notification_groups through
+eager celery. The fake servers run in this process so they don't weigh
+on the measurements.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from tests.fake_servers import (
+    FakeAPNSConnection,
+    FakeAPNSServer,
+    FakeGCMServer
+)
+
+SEED_BATCH_SIZE = 10000
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, nargs='+',
+                        default=[10000, 100000, 1000000],
+                        help='numbers of devices to send to')
+    parser.add_argument('--ios-ratio', type=float, default=0.3,
+                        help='fraction of iOS devices')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the fake servers wait per response')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of devices failing on the servers')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='PUSHY_DEVICE_KEY_LIMIT')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='PUSHY_DISPATCH_THREADS')
+    parser.add_argument('--engine', default='sync',
+                        help='PUSHY_DISPATCH_ENGINE')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--gcm-url', help=argparse.SUPPRESS)
+    parser.add_argument('--apns-port', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def setup_django(args):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+    import celery
+    import django
+    from django.conf import settings
+
+    django.setup()
+    settings.PUSHY_GCM_URL = args.gcm_url
+    settings.PUSHY_DEVICE_KEY_LIMIT = args.chunk_size
+    settings.PUSHY_DISPATCH_THREADS = args.threads
+    settings.PUSHY_DISPATCH_ENGINE = args.engine
+
+    app = celery.Celery('benchmarks')
+    app.config_from_object('django.conf:settings')
+
+    from pushjack import APNSClient
+    APNSClient.create_connection = lambda client: FakeAPNSConnection(
+        '127.0.0.1',
+        args.apns_port
+    )
+
+
+def reset_database():
+    from django.conf import settings
+    from django.core.management import call_command
+
+    database = settings.DATABASES['default']
+    if database['ENGINE'].endswith('sqlite3') and \
+            os.path.exists(database['NAME']):
+        os.remove(database['NAME'])
+
+    call_command('migrate', verbosity=0, interactive=False)
+
+
+def seed_devices(count, ios_ratio):
+    from pushy.models import Device
+
+    ios_count = int(count * ios_ratio)
+    devices = []
+    for i in range(count):
+        if i < ios_count:
+            devices.append(Device(key='{:064x}'.format(i + 1),
+                                  type=Device.DEVICE_TYPE_IOS))
+        else:
+            devices.append(Device(key='ANDROID_{}'.format(i),
+                                  type=Device.DEVICE_TYPE_ANDROID))
+
+        if len(devices) >= SEED_BATCH_SIZE:
+            Device.objects.bulk_create(devices)
+            devices = []
+
+    Device.objects.bulk_create(devices)
+
+
+def peak_memory():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak * 1024
+
+
+def run_child(args):
+    setup_django(args)
+    reset_database()
+
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from pushy.models import DeadLetter, PushNotification
+    from pushy.tasks import create_push_notification_groups
+
+    count = args.devices[0]
+    seed_devices(count, args.ios_ratio)
+
+    notification = PushNotification.objects.create(
+        title='benchmark',
+        payload={'title': 'Benchmark', 'message': 'Hello', 'key': 'value'}
+    )
+
+    started = time.time()
+    with CaptureQueriesContext(connection) as queries:
+        create_push_notification_groups(notification.to_dict())
+    elapsed = time.time() - started
+
+    print(json.dumps({
+        'devices': count,
+        'seconds': elapsed,
+        'queries': len(queries),
+        'failed': DeadLetter.objects.count(),
+        'peak_memory': peak_memory()
+    }))
+
+
+def run_size(args, count, gcm_server, apns_server):
+    command = [
+        sys.executable, '-m', 'benchmarks.run', '--child',
+        '--devices', str(count),
+        '--ios-ratio', str(args.ios_ratio),
+        '--chunk-size', str(args.chunk_size),
+        '--engine', args.engine,
+        '--gcm-url', gcm_server.url,
+        '--apns-port', str(apns_server.address[1])
+    ]
+    if args.threads:
+        command += ['--threads', str(args.threads)]
+
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    if args.child:
+        return run_child(args)
+
+    servers = dict(latency=args.latency, error_rate=args.error_rate,
+                   record=False)
+    with FakeGCMServer(**servers) as gcm_server, \
+            FakeAPNSServer(**servers) as apns_server:
+        print('{:>10} {:>10} {:>12} {:>12} {:>12} {:>10}'.format(
+            'devices', 'seconds', 'msgs/sec', 'queries/msg', 'peak MB',
+            'failed'
+        ))
+        for count in args.devices:
+            result = run_size(args, count, gcm_server, apns_server)
+            print('{:>10} {:>10.2f} {:>12.0f} {:>12.4f} {:>12.1f} {:>10}'
+                  .format(
+                      result['devices'],
+                      result['seconds'],
+                      result['devices'] / result['seconds'],
+                      float(result['queries']) / result['devices'],
+                      result['peak_memory'] / 1024.0 / 1024.0,
+                      result['failed']
+                  ))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
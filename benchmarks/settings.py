@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+# The database is recreated for every run, point PUSHY_BENCHMARK_DB
+# somewhere else to keep it on another disk
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get(
+            'PUSHY_BENCHMARK_DB',
+            os.path.join(tempfile.gettempdir(), 'pushy_benchmark.sqlite3')
+        )
+    }
+}
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'pushy',
+]
+
+SECRET_KEY = 'django-pushy-benchmark'
+USE_TZ = True
+
+CELERY_ALWAYS_EAGER = True
+CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
+
+PUSHY_GCM_API_KEY = 'SOME_TEST_KEY'
+PUSHY_GCM_JSON_PAYLOAD = True
+PUSHY_APNS_CERTIFICATE_FILE = 'fake-certificate.pem'
+
+# Failed devices go straight to the dead letters, eager retries would
+# otherwise run inline
+PUSHY_MAX_RETRIES = 0
+PUSHY_APNS_ERROR_TIMEOUT = 0.05
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'loggers': {
+        'pushy': {'level': 'CRITICAL'},
+    },
+}
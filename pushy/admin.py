@@ -2,10 +2,34 @@ import json
 from django.contrib import admin
 from django import forms
 
-from .models import PushNotification, Device
+from .models import (
+    DeadLetter,
+    Device,
+    PushDelivery,
+    PushNotification,
+    PushNotificationTarget
+)
+from .utils import replay_dead_letters
 
 
 class PushNotificationForm(forms.ModelForm):
+    filter_types = forms.TypedMultipleChoiceField(
+        choices=Device.DEVICE_TYPE_CHOICES,
+        coerce=int,
+        required=False,
+        widget=forms.CheckboxSelectMultiple
+    )
+
+    def __init__(self, *args, **kwargs):
+        super(PushNotificationForm, self).__init__(*args, **kwargs)
+        self.initial['filter_types'] = self.instance.device_types
+
+    def clean_filter_types(self):
+        # Stored as the comma separated types of device_types
+        notification = PushNotification()
+        notification.device_types = self.cleaned_data['filter_types']
+        return notification.filter_types
+
     def clean(self):
         body = self.cleaned_data.get('body')
         try:
@@ -17,10 +41,16 @@ class PushNotificationForm(forms.ModelForm):
     class Meta:
         model = PushNotification
         fields = (
-            'title', 'body', 'active', 'sent', 'filter_type', 'filter_user'
+            'title', 'body', 'active', 'sent', 'filter_type', 'filter_user',
+            'filter_types'
         )
 
 
+class PushNotificationTargetInline(admin.TabularInline):
+    model = PushNotificationTarget
+    extra = 0
+
+
 class PushNotificationAdmin(admin.ModelAdmin):
     form = PushNotificationForm
     list_display = (
@@ -28,18 +58,72 @@ class PushNotificationAdmin(admin.ModelAdmin):
         'date_created',
         'active',
         'sent',
+        'audience_size',
         'date_started',
         'date_finished'
     )
     list_filter = ('active', 'sent')
     search_fields = ('title', )
-    readonly_fields = ('date_started', 'date_finished')
+    readonly_fields = ('audience_size', 'date_started', 'date_finished')
+    inlines = (PushNotificationTargetInline, )
+
+    def save_related(self, request, form, formsets, change):
+        super(PushNotificationAdmin, self).save_related(
+            request, form, formsets, change
+        )
+        # Only send to the targets' users when there are any
+        notification = form.instance
+        filter_targets = notification.targets.exists()
+        if notification.filter_targets != filter_targets:
+            notification.filter_targets = filter_targets
+            PushNotification.objects.filter(pk=notification.pk).update(
+                filter_targets=filter_targets
+            )
 
 
 class DeviceAdmin(admin.ModelAdmin):
-    list_display = ('key', )
+    list_display = ('key', 'last_registered', 'last_success')
     list_filter = ('user', )
 
 
+def replay_selected_dead_letters(modeladmin, request, queryset):
+    count = replay_dead_letters(queryset)
+    modeladmin.message_user(
+        request,
+        '{} dead letters queued for sending'.format(count)
+    )
+
+
+replay_selected_dead_letters.short_description = \
+    'Send selected dead letters again'
+
+
+class DeadLetterAdmin(admin.ModelAdmin):
+    list_display = (
+        'notification',
+        'device',
+        'error',
+        'attempts',
+        'date_created'
+    )
+    list_filter = ('error', )
+    actions = (replay_selected_dead_letters, )
+
+
+class PushDeliveryAdmin(admin.ModelAdmin):
+    list_display = (
+        'notification',
+        'device',
+        'status',
+        'error',
+        'latency',
+        'date_created'
+    )
+    list_filter = ('status', 'error')
+    raw_id_fields = ('notification', 'device')
+
+
 admin.site.register(PushNotification, PushNotificationAdmin)
 admin.site.register(Device, DeviceAdmin)
+admin.site.register(DeadLetter, DeadLetterAdmin)
+admin.site.register(PushDelivery, PushDeliveryAdmin)
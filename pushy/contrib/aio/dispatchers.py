@@ -0,0 +1,172 @@
+import asyncio
+
+import aiohttp
+
+from django.conf import settings
+from pushjack.exceptions import gcm_server_errors
+from pushjack.gcm import GCM_MAX_RECIPIENTS
+from pushjack.utils import json_dumps
+
+from pushy.dispatchers import (
+    GCMDispatcher,
+    map_gcm_exception,
+    parse_retry_after
+)
+from pushy.exceptions import (
+    PushAuthException,
+    PushInvalidDataException,
+    PushServerException
+)
+
+
+class AsyncGCMDispatcher(GCMDispatcher):
+    """GCM dispatcher sending the requests of a batch concurrently.
+
+    Device keys are split into requests of at most ``batch_size`` keys
+    which are posted over a shared keep-alive session, with no more than
+    ``concurrency`` requests in flight at once.
+    """
+    def __init__(self, api_key=None):
+        super(AsyncGCMDispatcher, self).__init__(api_key)
+        self._loop = None
+        self._session = None
+
+    @property
+    def concurrency(self):
+        return int(getattr(settings, 'PUSHY_ASYNC_CONCURRENCY', 100))
+
+    @property
+    def batch_size(self):
+        # Well below the default chunk size so that every chunk is sent
+        # with several requests in flight
+        return min(
+            int(getattr(settings, 'PUSHY_ASYNC_BATCH_SIZE', 100)),
+            GCM_MAX_RECIPIENTS
+        )
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'PUSHY_ASYNC_TIMEOUT', 10)
+
+    @property
+    def loop(self):
+        if not self._loop or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+            self._session = None
+        return self._loop
+
+    def get_session(self):
+        if not self._session or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                headers={
+                    'Authorization': 'key={0}'.format(self._api_key),
+                    'Content-Type': 'application/json',
+                }
+            )
+        return self._session
+
+    def close(self):
+        if self._session and not self._session.closed:
+            self.loop.run_until_complete(self._session.close())
+        if self._loop and not self._loop.is_closed():
+            self._loop.close()
+        self._session = None
+        self._loop = None
+
+    def send_batch(self, device_keys, payload):
+        if not self._api_key:
+            raise PushAuthException()
+
+        device_keys = list(device_keys)
+        self.throttle(len(device_keys))
+
+        return self.loop.run_until_complete(
+            self.send_batch_async(device_keys, payload)
+        )
+
+    async def send_batch_async(self, device_keys, payload):
+        payload = self.get_prepared(payload)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        session = self.get_session()
+
+        async def send_request(request_keys):
+            async with semaphore:
+                return await self._post(session, request_keys, payload)
+
+        responses = await asyncio.gather(*[
+            send_request(device_keys[pos:pos + self.batch_size])
+            for pos in range(0, len(device_keys), self.batch_size)
+        ])
+
+        canonical_ids = {}
+        errors = {}
+        for request_canonical_ids, request_errors in responses:
+            canonical_ids.update(request_canonical_ids)
+            errors.update(request_errors)
+
+        return canonical_ids, errors
+
+    async def _post(self, session, device_keys, payload):
+        # Splice the device keys into the message serialized beforehand
+        body = b''.join([
+            b'{"registration_ids":',
+            json_dumps(device_keys),
+            b',' if payload.body != b'{}' else b'',
+            payload.body[1:]
+        ])
+
+        try:
+            async with session.post(
+                    self.url,
+                    data=body,
+                    timeout=aiohttp.ClientTimeout(total=self.timeout)
+            ) as response:
+                if response.status == 401:
+                    raise PushAuthException()
+                if response.status == 400:
+                    # Only this request's keys were rejected
+                    return {}, dict(
+                        (device_key, PushInvalidDataException())
+                        for device_key in device_keys
+                    )
+                if response.status != 200:
+                    return {}, self._failed(
+                        device_keys,
+                        parse_retry_after(response.headers.get('Retry-After'))
+                    )
+
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return {}, self._failed(device_keys)
+
+        return self._parse_results(device_keys, data.get('results', []))
+
+    def _failed(self, device_keys, retry_after=None):
+        return dict(
+            (device_key, PushServerException(retry_after=retry_after))
+            for device_key in device_keys
+        )
+
+    def _parse_results(self, device_keys, results):
+        canonical_ids = {}
+        errors = {}
+
+        for device_key, result in zip(device_keys, results):
+            if 'error' in result:
+                error_class = gcm_server_errors.get(result['error'])
+                if error_class:
+                    errors[device_key] = map_gcm_exception(
+                        error_class(device_key)
+                    )
+                else:
+                    errors[device_key] = PushServerException()
+
+            if 'registration_id' in result:
+                canonical_ids[device_key] = result['registration_id']
+
+        # Keys the server didn't report a result for weren't delivered
+        for device_key in device_keys[len(results):]:
+            errors[device_key] = PushServerException()
+
+        return canonical_ids, errors
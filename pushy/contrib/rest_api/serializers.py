@@ -20,3 +20,9 @@ class DeviceSerializer(serializers.ModelSerializer):
     class Meta:
         model = Device
         fields = ('key', 'type', 'user')
+        # Existing devices are reassigned by register_device
+        validators = []
+
+
+class DeviceKeySerializer(serializers.Serializer):
+    key = serializers.CharField(max_length=255)
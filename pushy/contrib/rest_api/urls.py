@@ -9,4 +9,10 @@ urlpatterns = [
             'delete': 'destroy'
         }),
         name='pushy-devices'),
+    url(r'^pushy/device/batch/$',
+        DeviceViewSet.as_view({
+            'post': 'batch_create',
+            'delete': 'batch_destroy'
+        }),
+        name='pushy-devices-batch'),
 ]
@@ -1,18 +1,28 @@
+from django.conf import settings
 from rest_framework import viewsets
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.settings import api_settings
 
-from pushy.models import Device
+from pushy.models import (
+    Device,
+    register_device,
+    register_devices,
+    unregister_devices
+)
 
-from .serializers import DeviceSerializer
+from .serializers import DeviceKeySerializer, DeviceSerializer
 
 
 class DeviceViewSet(viewsets.ViewSet):
     def create(self, request):
         serializer = DeviceSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        serializer.save(user_id=request.user.id)
+        register_device(
+            serializer.validated_data['key'],
+            serializer.validated_data['type'],
+            request.user.id
+        )
 
         return Response(
             request.data,
@@ -31,9 +41,84 @@ class DeviceViewSet(viewsets.ViewSet):
         except Device.DoesNotExist:
             return self._not_found_response(key)
 
-    def _not_found_response(self, key):
+    def batch_create(self, request):
+        error = self._check_batch(request.data)
+        if error:
+            return error
+
+        results, validated_data = self._validate_batch(
+            request.data, DeviceSerializer, status.HTTP_201_CREATED
+        )
+        register_devices(
+            [(item['key'], item['type']) for item in validated_data],
+            request.user.id
+        )
+
+        return Response(results, status=status.HTTP_200_OK)
+
+    def batch_destroy(self, request):
+        error = self._check_batch(request.data)
+        if error:
+            return error
+
+        results, validated_data = self._validate_batch(
+            request.data, DeviceKeySerializer, status.HTTP_200_OK
+        )
+        found_keys = unregister_devices(
+            [item['key'] for item in validated_data]
+        )
+        for result in results:
+            if result['status'] == status.HTTP_200_OK and \
+                    result['data']['key'] not in found_keys:
+                result['status'] = status.HTTP_404_NOT_FOUND
+                result['errors'] = self._not_found_errors(
+                    result['data']['key']
+                )
+
+        return Response(results, status=status.HTTP_200_OK)
+
+    def _check_batch(self, data):
         errors_key = api_settings.NON_FIELD_ERRORS_KEY
+        max_size = getattr(settings, 'PUSHY_DEVICE_BATCH_MAX_SIZE', 1000)
+
+        if not isinstance(data, list):
+            message = 'Expected a list of devices'
+        elif len(data) > max_size:
+            message = 'At most {} devices can be sent at once'.format(
+                max_size
+            )
+        else:
+            return None
+
+        return Response(data={errors_key: [message]},
+                        status=status.HTTP_400_BAD_REQUEST)
 
-        return Response(data={
-            errors_key: ['Key {} was not found'.format(key)]
-        }, status=status.HTTP_404_NOT_FOUND)
+    def _validate_batch(self, data, serializer_class, success_status):
+        # Validate every item on its own so that invalid items don't fail
+        # the whole batch, results are returned in the order of the items
+        results = []
+        validated_data = []
+        for item in data:
+            serializer = serializer_class(data=item)
+            if serializer.is_valid():
+                validated_data.append(serializer.validated_data)
+                results.append({'data': item, 'status': success_status})
+            else:
+                results.append({
+                    'data': item,
+                    'status': status.HTTP_400_BAD_REQUEST,
+                    'errors': serializer.errors
+                })
+
+        return results, validated_data
+
+    def _not_found_errors(self, key):
+        return {
+            api_settings.NON_FIELD_ERRORS_KEY: [
+                'Key {} was not found'.format(key)
+            ]
+        }
+
+    def _not_found_response(self, key):
+        return Response(data=self._not_found_errors(key),
+                        status=status.HTTP_404_NOT_FOUND)
@@ -1,10 +1,24 @@
-import copy
+import os
+import threading
+import time
+
+from email.utils import mktime_tz, parsedate_tz
+
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from requests.adapters import HTTPAdapter
 from pushjack import (
     APNSClient,
     APNSSandboxClient,
     GCMClient
 )
+from pushjack.apns import (
+    APNS_MAX_NOTIFICATION_SIZE,
+    APNSMessage,
+    invalid_tokens
+)
+from pushjack.gcm import GCM_URL, GCMMessage
+from pushjack.utils import json_dumps
 from pushjack.exceptions import (
     GCMAuthError,
     GCMMissingRegistrationError,
@@ -34,21 +48,176 @@ from pushjack.exceptions import (
 
 from .models import Device
 from .exceptions import (
+    PushException,
     PushAuthException,
     PushInvalidTokenException,
     PushInvalidDataException,
+    PushRateLimitException,
     PushServerException
 )
+from .ratelimit import get_rate_limiter
 
 dispatchers_cache = {}
+dispatchers_pid = None
+thread_dispatchers = threading.local()
+
+# GCM rejects messages whose data payload exceeds 4KB
+GCM_MAX_DATA_SIZE = 4096
+
+
+GCM_EXCEPTIONS_MAP = (
+    (GCMAuthError, PushAuthException),
+    ((GCMMissingRegistrationError,
+      GCMInvalidRegistrationError,
+      GCMUnregisteredDeviceError), PushInvalidTokenException),
+    ((GCMInvalidPackageNameError,
+      GCMMismatchedSenderError,
+      GCMMessageTooBigError,
+      GCMInvalidDataKeyError,
+      GCMInvalidTimeToLiveError), PushInvalidDataException),
+    (GCMDeviceMessageRateExceededError, PushRateLimitException),
+    ((GCMTimeoutError,
+      GCMInternalServerError), PushServerException),
+)
+
+APNS_EXCEPTIONS_MAP = (
+    (APNSAuthError, PushAuthException),
+    ((APNSMissingTokenError,
+      APNSInvalidTokenError), PushInvalidTokenException),
+    ((APNSProcessingError,
+      APNSMissingTopicError,
+      APNSMissingPayloadError,
+      APNSInvalidTokenSizeError,
+      APNSInvalidTopicSizeError,
+      APNSInvalidPayloadSizeError), PushInvalidDataException),
+    ((APNSShutdownError,
+      APNSUnknownError), PushServerException),
+)
+
+
+def map_exception(exc, exceptions_map):
+    """Translate a provider exception into its pushy counterpart.
+
+    Anything that is not explicitly mapped is treated as a server error.
+    """
+    if isinstance(exc, PushException):
+        return exc
+
+    for provider_exceptions, push_exception in exceptions_map:
+        if isinstance(exc, provider_exceptions):
+            return push_exception()
+
+    return PushServerException()
+
+
+def get_gcm_message_keys(message):
+    # pushjack sends requests for a single key with a "to" field
+    message = message or {}
+    if message.get('registration_ids'):
+        return message['registration_ids']
+    return [message['to']] if message.get('to') else []
+
+
+def parse_retry_after(value):
+    """Return the delay in seconds asked for by a Retry-After header.
+
+    The header holds either a number of seconds or an HTTP date.
+    """
+    if not value:
+        return None
+
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+
+    return max(0, int(mktime_tz(date) - time.time()))
+
+
+def map_gcm_exception(exc):
+    return map_exception(exc, GCM_EXCEPTIONS_MAP)
+
+
+def map_apns_exception(exc):
+    return map_exception(exc, APNS_EXCEPTIONS_MAP)
+
+
+class PreparedPayload(object):
+    """Notification payload compiled once for a provider.
+
+    ``data`` holds the arguments handed to the provider client and ``body``
+    the serialized message, without any device keys.
+    """
+    __slots__ = ('payload', 'data', 'body')
+
+    def __init__(self, payload, data, body=None):
+        self.payload = payload
+        self.data = data
+        self.body = body
 
 
 class Dispatcher(object):
+    provider = None
+
+    @property
+    def credential(self):
+        return None
+
+    def throttle(self, count):
+        # Wait until `count` more messages fit in the provider's rate limit
+        rate_limiter = get_rate_limiter(self.provider, self.credential)
+        if rate_limiter:
+            rate_limiter.acquire(count)
+
     def send(self, device_key, data):
         raise NotImplementedError()
 
+    def prepare(self, payload):
+        """Compile a payload so it can be sent to many devices without
+        being copied or serialized again for each of them.
+
+        Raises ``PushInvalidDataException`` if the provider would reject it.
+        """
+        return PreparedPayload(payload, payload)
+
+    def get_prepared(self, payload):
+        if isinstance(payload, PreparedPayload):
+            return payload
+        return self.prepare(payload)
+
+    def send_batch(self, device_keys, data):
+        """Send the same payload to many devices.
+
+        Returns a tuple of ``(canonical_ids, errors)`` where
+        ``canonical_ids`` maps a device key to its new canonical key and
+        ``errors`` maps a device key to the ``PushException`` raised for it.
+        Keys missing from ``errors`` were delivered successfully.
+
+        Dispatchers that can't multicast fall back to one request per key.
+        """
+        canonical_ids = {}
+        errors = {}
+
+        for device_key in device_keys:
+            try:
+                canonical_id = self.send(device_key, data)
+                if canonical_id:
+                    canonical_ids[device_key] = canonical_id
+            except (PushInvalidTokenException,
+                    PushInvalidDataException,
+                    PushServerException) as exc:
+                errors[device_key] = exc
+
+        return canonical_ids, errors
+
 
 class APNSDispatcher(Dispatcher):
+    provider = 'apns'
+
     def __init__(self):
         super(APNSDispatcher, self).__init__()
         self._client = None
@@ -57,10 +226,23 @@ class APNSDispatcher(Dispatcher):
     def cert_file(self):
         return getattr(settings, 'PUSHY_APNS_CERTIFICATE_FILE', None)
 
+    @property
+    def credential(self):
+        return self.cert_file
+
     @property
     def use_sandbox(self):
         return bool(getattr(settings, 'PUSHY_APNS_SANDBOX', False))
 
+    @property
+    def batch_size(self):
+        return int(getattr(settings, 'PUSHY_APNS_BATCH_SIZE', 100))
+
+    @property
+    def error_timeout(self):
+        # Seconds to wait for an error response after every batch
+        return getattr(settings, 'PUSHY_APNS_ERROR_TIMEOUT', 10)
+
     def establish_connection(self):
         if self.cert_file is None:
             raise PushAuthException('Missing APNS certificate error')
@@ -71,54 +253,78 @@ class APNSDispatcher(Dispatcher):
 
         self._client = target_class(
             certificate=self.cert_file,
-            default_error_timeout=10,
+            default_error_timeout=self.error_timeout,
             default_expiration_offset=2592000,
-            default_batch_size=100
+            default_batch_size=self.batch_size
         )
 
-    def _send(self, token, notification_payload):
+    def _build_notification(self, notification_payload):
         # pop causes a bug in altering the original payload
         # which causes title and message to be empty
         # for notifications following the currrent one.
-        payload = copy.deepcopy(notification_payload)
+        payload = dict(notification_payload)
+
+        return {
+            'title': payload.pop('title', None),
+            'message': payload.pop('message', None),
+            'sound': payload.pop('sound', None),
+            'badge': payload.pop('badge', None),
+            'category': payload.pop('category', None),
+            'content_available': True,
+            'extra': payload or {}
+        }
+
+    def prepare(self, payload):
+        notification = self._build_notification(payload)
+
+        body = APNSMessage(**notification).to_json()
+        if len(body) > APNS_MAX_NOTIFICATION_SIZE:
+            raise PushInvalidDataException(
+                'Notification body cannot exceed {} bytes'.format(
+                    APNS_MAX_NOTIFICATION_SIZE
+                )
+            )
+
+        return PreparedPayload(payload, notification, body)
+
+    def _send(self, token, notification_payload):
+        notification = self.get_prepared(notification_payload).data
+        self.throttle(1)
 
         try:
-            response = self._client.send(
-                [token],
-                title=payload.pop('title', None),
-                message=payload.pop('message', None),
-                sound=payload.pop('sound', None),
-                badge=payload.pop('badge', None),
-                category=payload.pop('category', None),
-                content_available=True,
-                extra=payload or {}
-            )
+            response = self._client.send([token], **notification)
 
             if response.errors:
                 raise response.errors.pop()
             return None
 
-        except APNSAuthError:
-            raise PushAuthException()
+        except Exception as exc:
+            raise map_apns_exception(exc)
+
+    def _send_batch(self, tokens, notification_payload):
+        notification = self.get_prepared(notification_payload).data
 
-        except (APNSMissingTokenError,
-                APNSInvalidTokenError):
-            raise PushInvalidTokenException()
+        # The client rejects the whole batch if any token is malformed,
+        # filter those out and report them as invalid instead
+        errors = dict(
+            (token, PushInvalidTokenException())
+            for token in invalid_tokens(tokens)
+        )
+        tokens = [token for token in tokens if token not in errors]
+        if not tokens:
+            return {}, errors
 
-        except (APNSProcessingError,
-                APNSMissingTopicError,
-                APNSMissingPayloadError,
-                APNSInvalidTokenSizeError,
-                APNSInvalidTopicSizeError,
-                APNSInvalidPayloadSizeError):
-            raise PushInvalidDataException()
+        self.throttle(len(tokens))
 
-        except (APNSShutdownError,
-                APNSUnknownError):
-            raise PushServerException()
+        try:
+            response = self._client.send(tokens, **notification)
+        except Exception as exc:
+            raise map_apns_exception(exc)
 
-        except:
-            raise PushServerException()
+        for token, error in response.token_errors.items():
+            errors[token] = map_apns_exception(error)
+
+        return {}, errors
 
     def send(self, device_key, payload):
         if not self._client:
@@ -126,20 +332,76 @@ class APNSDispatcher(Dispatcher):
 
         return self._send(device_key, payload)
 
+    def send_batch(self, device_keys, payload):
+        if not self._client:
+            self.establish_connection()
+
+        return self._send_batch(device_keys, payload)
+
 
 class GCMDispatcher(Dispatcher):
+    provider = 'gcm'
+
     def __init__(self, api_key=None):
+        super(GCMDispatcher, self).__init__()
         if not api_key:
             api_key = getattr(settings, 'PUSHY_GCM_API_KEY', None)
         self._api_key = api_key
+        self._client = None
+
+    @property
+    def credential(self):
+        return self._api_key
+
+    @property
+    def url(self):
+        return getattr(settings, 'PUSHY_GCM_URL', GCM_URL)
+
+    @property
+    def pool_size(self):
+        return int(getattr(settings, 'PUSHY_GCM_POOL_SIZE', 10))
+
+    def establish_connection(self):
+        self._client = GCMClient(self._api_key)
+        self._client.url = self.url
+
+        # Keep connections to the GCM server alive between sends
+        # instead of paying for a new TLS handshake on every request
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size
+        )
+        session = self._client.conn.session
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    @property
+    def client(self):
+        if not self._client:
+            self.establish_connection()
+        return self._client
+
+    def prepare(self, payload):
+        message = GCMMessage([], payload).to_dict()
+        message.pop('registration_ids', None)
+
+        if len(json_dumps(message.get('data', {}))) > GCM_MAX_DATA_SIZE:
+            raise PushInvalidDataException(
+                'Notification data cannot exceed {} bytes'.format(
+                    GCM_MAX_DATA_SIZE
+                )
+            )
+
+        return PreparedPayload(payload, payload, json_dumps(message))
 
     def _send(self, device_key, payload):
         if not self._api_key:
             raise PushAuthException()
 
-        gcm_client = GCMClient(self._api_key)
+        payload = self.get_prepared(payload).data
+        self.throttle(1)
         try:
-            response = gcm_client.send(
+            response = self.client.send(
                 [device_key],
                 payload
             )
@@ -152,40 +414,119 @@ class GCMDispatcher(Dispatcher):
                 canonical_id = response.canonical_ids[0].new_id
             return canonical_id
 
-        except GCMAuthError:
-            raise PushAuthException()
+        except Exception as exc:
+            raise map_gcm_exception(exc)
 
-        except (GCMMissingRegistrationError,
-                GCMInvalidRegistrationError,
-                GCMUnregisteredDeviceError):
-            raise PushInvalidTokenException()
+    def _send_batch(self, device_keys, payload):
+        if not self._api_key:
+            raise PushAuthException()
 
-        except (GCMInvalidPackageNameError,
-                GCMMismatchedSenderError,
-                GCMMessageTooBigError,
-                GCMInvalidDataKeyError,
-                GCMInvalidTimeToLiveError):
-            raise PushInvalidDataException()
+        device_keys = list(device_keys)
+        payload = self.get_prepared(payload).data
+        self.throttle(len(device_keys))
+        try:
+            response = self.client.send(
+                device_keys,
+                payload
+            )
+        except Exception as exc:
+            raise map_gcm_exception(exc)
 
-        except (GCMTimeoutError,
-                GCMInternalServerError,
-                GCMDeviceMessageRateExceededError):
-            raise PushServerException()
+        canonical_ids = dict(
+            (canonical.old_id, canonical.new_id)
+            for canonical in response.canonical_ids
+        )
+        errors = dict(
+            (error.identifier, map_gcm_exception(error))
+            for error in response.errors
+        )
+        # Tokens which failed with an error code pushjack does not know
+        # about are reported in failures only
+        for device_key in response.failures:
+            if device_key not in errors:
+                errors[device_key] = PushServerException()
+
+        # Requests rejected as a whole don't report per token results
+        for http_response, message in zip(response.responses,
+                                          response.messages):
+            if http_response.status_code == 200:
+                continue
+            if http_response.status_code == 401:
+                raise PushAuthException()
+
+            retry_after = parse_retry_after(
+                http_response.headers.get('Retry-After')
+            )
+            for device_key in get_gcm_message_keys(message):
+                if http_response.status_code == 400:
+                    errors[device_key] = PushInvalidDataException()
+                else:
+                    errors[device_key] = PushServerException(
+                        retry_after=retry_after
+                    )
 
-        except:
-            raise PushServerException()
+        return canonical_ids, errors
 
     def send(self, device_key, payload):
         return self._send(device_key, payload)
 
+    def send_batch(self, device_keys, payload):
+        return self._send_batch(device_keys, payload)
+
+
+def get_gcm_dispatcher_class():
+    engine = getattr(settings, 'PUSHY_DISPATCH_ENGINE', 'sync')
+
+    if engine == 'sync':
+        return GCMDispatcher
+
+    if engine == 'asyncio':
+        try:
+            from .contrib.aio.dispatchers import AsyncGCMDispatcher
+        except (ImportError, SyntaxError):
+            raise ImproperlyConfigured(
+                'The asyncio dispatch engine requires Python 3.5+ '
+                'and aiohttp, install django-pushy[aio]'
+            )
+        return AsyncGCMDispatcher
+
+    raise ImproperlyConfigured(
+        'Unknown PUSHY_DISPATCH_ENGINE "{}"'.format(engine)
+    )
+
 
 def get_dispatcher(device_type):
+    global dispatchers_pid
+
+    # Dispatchers hold open connections which must not be shared with
+    # forked worker processes, start over with fresh ones after a fork
+    if dispatchers_pid != os.getpid():
+        dispatchers_cache.clear()
+        dispatchers_pid = os.getpid()
+
     if device_type in dispatchers_cache and dispatchers_cache[device_type]:
         return dispatchers_cache[device_type]
 
     if device_type == Device.DEVICE_TYPE_ANDROID:
-        dispatchers_cache[device_type] = GCMDispatcher()
+        dispatchers_cache[device_type] = get_gcm_dispatcher_class()()
     else:
         dispatchers_cache[device_type] = APNSDispatcher()
 
     return dispatchers_cache[device_type]
+
+
+def get_thread_dispatcher(device_type):
+    # Dispatchers are not safe to share between threads (the APNS client
+    # writes to a single socket), give every thread its own set
+    cache = getattr(thread_dispatchers, 'cache', None)
+    if cache is None or thread_dispatchers.pid != os.getpid():
+        cache = thread_dispatchers.cache = {}
+        thread_dispatchers.pid = os.getpid()
+
+    if device_type not in cache:
+        if device_type == Device.DEVICE_TYPE_ANDROID:
+            cache[device_type] = get_gcm_dispatcher_class()()
+        else:
+            cache[device_type] = APNSDispatcher()
+
+    return cache[device_type]
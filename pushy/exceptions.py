@@ -15,4 +15,11 @@ class PushInvalidDataException(PushException):
 
 
 class PushServerException(PushException):
+    def __init__(self, *args, **kwargs):
+        # Seconds the provider asked us to wait before retrying
+        self.retry_after = kwargs.pop('retry_after', None)
+        super(PushServerException, self).__init__(*args, **kwargs)
+
+
+class PushRateLimitException(PushServerException):
     pass
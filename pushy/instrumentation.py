@@ -0,0 +1,77 @@
+import socket
+import time
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+backends_cache = {}
+
+
+class InstrumentationBackend(object):
+    """Receive the counters and timings emitted while sending.
+
+    This default backend discards everything, subclasses only need to
+    implement ``incr`` and ``timing``.
+    """
+    def incr(self, name, count=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    @contextmanager
+    def timer(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.timing(name, time.time() - started)
+
+
+class StatsdBackend(InstrumentationBackend):
+    """Send metrics to a statsd server over UDP.
+
+    Timings are sent in milliseconds, statsd turns them into histograms.
+    Metrics are fire and forget, nothing is raised if they can't be sent.
+    """
+    def __init__(self, host='localhost', port=8125, prefix='pushy'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, metric_type):
+        if self.prefix:
+            name = '{}.{}'.format(self.prefix, name)
+
+        data = '{}:{}|{}'.format(name, value, metric_type)
+        try:
+            self.socket.sendto(data.encode('utf-8'), self.address)
+        except (socket.error, socket.gaierror):
+            pass
+
+    def incr(self, name, count=1):
+        self.send(name, count, 'c')
+
+    def timing(self, name, seconds):
+        self.send(name, int(round(seconds * 1000)), 'ms')
+
+
+def get_instrumentation():
+    """Return the backend set with ``PUSHY_INSTRUMENTATION_BACKEND``.
+
+    The backend is given ``PUSHY_INSTRUMENTATION_OPTIONS`` as keyword
+    arguments and reused for the life of the process.
+    """
+    path = getattr(settings, 'PUSHY_INSTRUMENTATION_BACKEND', None)
+    options = getattr(settings, 'PUSHY_INSTRUMENTATION_OPTIONS', {})
+    key = (path, tuple(sorted(options.items())))
+
+    if key not in backends_cache:
+        if path:
+            backends_cache[key] = import_string(path)(**options)
+        else:
+            backends_cache[key] = InstrumentationBackend()
+
+    return backends_cache[key]
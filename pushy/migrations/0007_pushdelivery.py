@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 01:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pushy', '0006_deadletter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushDelivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.SmallIntegerField(choices=[(1, 'Sent'), (2, 'Invalid Token'), (3, 'Failed')])),
+                ('error', models.CharField(blank=True, max_length=100)),
+                ('latency', models.FloatField(blank=True, null=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('device', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='pushy.Device')),
+                ('notification', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='pushy.PushNotification')),
+            ],
+        ),
+    ]
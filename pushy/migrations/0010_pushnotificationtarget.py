@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 01:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pushy', '0009_pushnotification_remaining_groups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushNotificationTarget',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.IntegerField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='pushnotification',
+            name='filter_targets',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='pushnotification',
+            name='filter_types',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='pushnotificationtarget',
+            name='notification',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='targets', to='pushy.PushNotification'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='pushnotificationtarget',
+            unique_together=set([('notification', 'user_id')]),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 01:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pushy', '0010_pushnotificationtarget'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='last_registered',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='last_success',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 02:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pushy', '0011_device_last_registered_last_success'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='deadletter',
+            name='body',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
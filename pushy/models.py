@@ -1,10 +1,27 @@
 import copy
 import json
+import time
 from django.conf import settings
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Case, CharField, F, Value, When
+from django.db.utils import IntegrityError
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 
+# SQLite builds older than 3.32 bind at most 999 parameters per statement,
+# statements with several parameters per row divide it by their columns
+MAX_QUERY_PARAMS = 999
+
+# Number of ids sent in a single IN clause
+BULK_QUERY_BATCH_SIZE = 250
+
+
+def _chunks(seq, size):
+    seq = list(seq)
+    return (seq[pos:pos + size] for pos in range(0, len(seq), size))
+
+
 class PushNotification(models.Model):
     PUSH_INACTIVE = 0
     PUSH_ACTIVE = 1
@@ -37,6 +54,14 @@ class PushNotification(models.Model):
     date_finished = models.DateTimeField(null=True)
     filter_type = models.SmallIntegerField(blank=True, default=0)
     filter_user = models.IntegerField(blank=True, default=0)
+    # Comma separated device types, for notifications sent to several types
+    filter_types = models.CharField(max_length=50, blank=True, default='')
+    # Only send to the users of the notification's targets
+    filter_targets = models.BooleanField(default=False)
+    # Number of devices targeted, stored once sending starts
+    audience_size = models.PositiveIntegerField(blank=True, null=True)
+    # Number of device chunks still being sent
+    remaining_groups = models.PositiveIntegerField(default=0)
 
     @property
     def payload(self):
@@ -48,6 +73,19 @@ class PushNotification(models.Model):
     def payload(self, value):
         self.body = json.dumps(value)
 
+    @property
+    def device_types(self):
+        return [
+            int(device_type)
+            for device_type in self.filter_types.split(',') if device_type
+        ]
+
+    @device_types.setter
+    def device_types(self, value):
+        self.filter_types = ','.join(
+            str(device_type) for device_type in sorted(set(value or []))
+        )
+
     def to_dict(self):
         # return notification as a dictionary
         # not including duplicate or model related fields
@@ -61,6 +99,19 @@ class PushNotification(models.Model):
         return self.title
 
 
+class PushNotificationTarget(models.Model):
+    # A user a notification is sent to
+    notification = models.ForeignKey(PushNotification, related_name='targets',
+                                     on_delete=models.CASCADE)
+    user_id = models.IntegerField()
+
+    class Meta:
+        unique_together = ('notification', 'user_id')
+
+    def __unicode__(self):
+        return 'User {}'.format(self.user_id)
+
+
 class Device(models.Model):
     DEVICE_TYPE_ANDROID = 1
     DEVICE_TYPE_IOS = 2
@@ -72,6 +123,10 @@ class Device(models.Model):
     key = models.CharField(max_length=255)
     type = models.SmallIntegerField(choices=DEVICE_TYPE_CHOICES)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True)
+    # Devices neither registered nor reached for a while are pruned
+    last_registered = models.DateTimeField(default=timezone.now,
+                                           db_index=True)
+    last_success = models.DateTimeField(blank=True, null=True, db_index=True)
 
     class Meta:
         unique_together = ('key', 'type')
@@ -82,6 +137,120 @@ class Device(models.Model):
         return "{} Device ID: {}".format(device_choices[self.type], self.pk)
 
 
+class DeadLetter(models.Model):
+    # A push notification which could not be delivered to a device,
+    # kept so that it can be replayed later
+    notification = models.ForeignKey(PushNotification, blank=True, null=True,
+                                     on_delete=models.CASCADE)
+    device = models.ForeignKey(Device, on_delete=models.CASCADE)
+    # Only set when the notification wasn't stored
+    body = models.TextField(blank=True, default='')
+    error = models.CharField(max_length=100)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def payload(self):
+        if self.body:
+            return json.loads(self.body)
+        return None
+
+    @payload.setter
+    def payload(self, value):
+        self.body = json.dumps(value)
+
+    def __unicode__(self):
+        return '{} for device {}'.format(self.error, self.device_id)
+
+
+class PushDelivery(models.Model):
+    # Outcome of sending a push notification to a device. Rows are kept
+    # after the device or notification is gone so no constraints are used,
+    # clean_sent_notifications removes them along with their notification.
+    DELIVERY_SENT = 1
+    DELIVERY_INVALID = 2
+    DELIVERY_FAILED = 3
+
+    DELIVERY_STATUS_CHOICES = (
+        (DELIVERY_SENT, _('Sent')),
+        (DELIVERY_INVALID, _('Invalid Token')),
+        (DELIVERY_FAILED, _('Failed'))
+    )
+
+    notification = models.ForeignKey(PushNotification, blank=True, null=True,
+                                     db_constraint=False,
+                                     on_delete=models.DO_NOTHING,
+                                     related_name='+')
+    device = models.ForeignKey(Device, db_constraint=False,
+                               on_delete=models.DO_NOTHING,
+                               related_name='+')
+    status = models.SmallIntegerField(choices=DELIVERY_STATUS_CHOICES)
+    error = models.CharField(max_length=100, blank=True)
+    # Seconds spent in the provider request which carried the device
+    latency = models.FloatField(blank=True, null=True)
+    date_created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __unicode__(self):
+        return '{} for device {}'.format(
+            self.get_status_display(),
+            self.device_id
+        )
+
+
+class PushDeliveryBuffer(object):
+    """Collect delivery records and write them with a few bulk inserts.
+
+    Records are flushed every ``size`` rows and whenever ``flush`` is
+    called, usually once at the end of a chunk.
+    """
+    def __init__(self, notification_id, size=1000):
+        self.notification_id = notification_id
+        self.size = size
+        self.deliveries = []
+
+    def add(self, device_id, status, error='', latency=None):
+        self.deliveries.append(PushDelivery(
+            notification_id=self.notification_id,
+            device_id=device_id,
+            status=status,
+            error=error,
+            latency=latency
+        ))
+
+        if len(self.deliveries) >= self.size:
+            self.flush()
+
+    def extend(self, records):
+        for record in records:
+            self.add(*record)
+
+    def flush(self):
+        if self.deliveries:
+            # Django sizes the inserts to the database's parameters limit
+            PushDelivery.objects.bulk_create(self.deliveries)
+        self.deliveries = []
+
+
+class DeviceRecord(object):
+    """The columns of a device needed to send it a notification.
+
+    Cheaper to build and smaller than a Device instance, used when
+    iterating over the devices of a chunk.
+    """
+    __slots__ = ('id', 'key', 'type')
+
+    def __init__(self, id, key, type):
+        self.id = id
+        self.key = key
+        self.type = type
+
+
+def get_device_records(devices):
+    # Stream DeviceRecords from a queryset, fetching only their columns
+    for row in devices.values_list('id', 'key', 'type').iterator():
+        yield DeviceRecord(*row)
+
+
 def get_filtered_devices_queryset(notification):
     devices = Device.objects.all()
 
@@ -89,5 +258,327 @@ def get_filtered_devices_queryset(notification):
         devices = devices.filter(type=notification['filter_type'])
     if 'filter_user' in notification and notification['filter_user']:
         devices = devices.filter(user_id=notification['filter_user'])
+    if notification.get('filter_types'):
+        devices = devices.filter(type__in=PushNotification(
+            filter_types=notification['filter_types']
+        ).device_types)
+    if notification.get('filter_targets'):
+        devices = filter_devices_by_targets(devices, notification['id'])
+
+    return devices
+
+
+def filter_devices_by_targets(devices, notification_id):
+    # The subquery doesn't depend on the device rows, the database
+    # resolves the notification's users once through the
+    # (notification, user_id) index and matches devices against them
+    return devices.filter(user_id__in=PushNotificationTarget.objects.filter(
+        notification_id=notification_id
+    ).values('user_id'))
+
 
+def create_push_notification_targets(notification, user_ids):
+    PushNotificationTarget.objects.bulk_create(
+        [
+            PushNotificationTarget(notification=notification, user_id=user_id)
+            for user_id in sorted(set(user_ids))
+        ],
+        batch_size=BULK_QUERY_BATCH_SIZE
+    )
+
+    notification.filter_targets = True
+    PushNotification.objects.filter(pk=notification.pk).update(
+        filter_targets=True
+    )
+
+
+def get_devices_id_ranges(devices, limit, after_id=0, until_id=None):
+    # Split devices into chunks of at most `limit` rows using primary key
+    # boundaries. Every boundary lookup seeks on the primary key index
+    # instead of scanning all preceding rows like OFFSET does.
+    # Yields (after_id, until_id) tuples, matching after_id < id <= until_id
+    ids = get_devices_in_range(
+        devices,
+        after_id,
+        until_id
+    ).values_list('id', flat=True)
+
+    while True:
+        boundary = list(ids.filter(id__gt=after_id)[limit - 1:limit])
+        if not boundary:
+            break
+        yield after_id, boundary[0]
+        after_id = boundary[0]
+
+    last_id = ids.filter(id__gt=after_id).last()
+    if last_id is not None:
+        yield after_id, last_id
+
+
+def get_audience_size(devices, id_ranges, limit, exact=True):
+    # Every range but the last one holds exactly `limit` devices, so only
+    # the last one needs counting. Without `exact` the count is skipped
+    # and an upper bound is returned instead.
+    if not id_ranges:
+        return 0
+
+    if not exact:
+        return len(id_ranges) * limit
+
+    return (len(id_ranges) - 1) * limit + get_devices_in_range(
+        devices, *id_ranges[-1]
+    ).count()
+
+
+def get_devices_in_range(devices, after_id=0, until_id=None):
+    devices = devices.filter(id__gt=after_id)
+    if until_id is not None:
+        devices = devices.filter(id__lte=until_id)
+    return devices.order_by('id')
+
+
+def update_devices_keys(canonical_ids):
+    # Apply canonical ids returned by the providers in bulk.
+    # `canonical_ids` is a list of (device_id, device_type, new_key) tuples.
+    # Devices whose new key is already registered are redundant and their
+    # ids are returned so that the caller can delete them.
+    redundant_ids = []
+    updates = {}
+    claimed_keys = set()
+
+    for device_type in set(item[1] for item in canonical_ids):
+        new_keys = [item[2] for item in canonical_ids
+                    if item[1] == device_type]
+        for keys in _chunks(new_keys, BULK_QUERY_BATCH_SIZE):
+            claimed_keys.update(
+                Device.objects.filter(
+                    type=device_type,
+                    key__in=keys
+                ).values_list('key', 'type')
+            )
+
+    for device_id, device_type, new_key in canonical_ids:
+        if (new_key, device_type) in claimed_keys:
+            redundant_ids.append(device_id)
+            continue
+        claimed_keys.add((new_key, device_type))
+        updates[device_id] = new_key
+
+    for device_ids in _chunks(updates.keys(), BULK_QUERY_BATCH_SIZE):
+        try:
+            with transaction.atomic():
+                Device.objects.filter(id__in=device_ids).update(key=Case(
+                    *[When(id=device_id, then=Value(updates[device_id]))
+                      for device_id in device_ids],
+                    default=F('key'),
+                    output_field=CharField()
+                ))
+        except IntegrityError:
+            # A conflicting key was registered in the meantime,
+            # fall back to updating this batch one device at a time
+            for device_id in device_ids:
+                try:
+                    with transaction.atomic():
+                        Device.objects.filter(id=device_id).update(
+                            key=updates[device_id]
+                        )
+                except IntegrityError:
+                    redundant_ids.append(device_id)
+
+    return redundant_ids
+
+
+def delete_devices(device_ids):
+    for ids in _chunks(device_ids, BULK_QUERY_BATCH_SIZE):
+        Device.objects.filter(id__in=ids).delete()
+
+
+def get_device_upsert_sql(rows=1):
+    # Insert devices or give existing (key, type) pairs to the new user in
+    # one statement, None when the database has no upsert
+    quote_name = connection.ops.quote_name
+    columns = {
+        'table': quote_name(Device._meta.db_table),
+        'key': quote_name(Device._meta.get_field('key').column),
+        'type': quote_name(Device._meta.get_field('type').column),
+        'user': quote_name(Device._meta.get_field('user').column),
+        'registered': quote_name(
+            Device._meta.get_field('last_registered').column
+        )
+    }
+    insert = ('INSERT INTO {table} ({key}, {type}, {user}, {registered}) '
+              'VALUES ' + ', '.join(['(%s, %s, %s, %s)'] * rows) + ' ')
+
+    # ON CONFLICT needs PostgreSQL 9.5 and SQLite 3.24
+    if (connection.vendor == 'postgresql' and
+            connection.pg_version >= 90500) or (
+            connection.vendor == 'sqlite' and
+            connection.Database.sqlite_version_info >= (3, 24, 0)):
+        return (insert + 'ON CONFLICT ({key}, {type}) '
+                'DO UPDATE SET {user} = excluded.{user}, '
+                '{registered} = excluded.{registered}').format(**columns)
+    if connection.vendor == 'mysql':
+        return (insert + 'ON DUPLICATE KEY UPDATE '
+                '{user} = VALUES({user}), '
+                '{registered} = VALUES({registered})').format(**columns)
+    return None
+
+
+def register_device(key, device_type, user_id=None):
+    register_devices([(key, device_type)], user_id)
+
+
+def register_devices(devices, user_id=None):
+    # Register (key, type) pairs for a user with one upsert per batch
+    devices = sorted(set(devices))
+    now = timezone.now()
+    registered = Device._meta.get_field('last_registered').get_db_prep_value(
+        now, connection
+    )
+
+    # Every row binds its key, type, user and registration date
+    for batch in _chunks(devices, MAX_QUERY_PARAMS // 4):
+        sql = get_device_upsert_sql(len(batch))
+        if sql:
+            params = []
+            for key, device_type in batch:
+                params.extend([key, device_type, user_id, registered])
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+        else:
+            _register_devices_batch(batch, user_id, now)
+
+
+def _register_devices_batch(devices, user_id, now):
+    # Update the registered devices then insert the others
+    registered = set()
+    for device_type in set(device[1] for device in devices):
+        existing = Device.objects.filter(
+            type=device_type,
+            key__in=[key for key, key_type in devices
+                     if key_type == device_type]
+        )
+        registered.update(existing.values_list('key', 'type'))
+        existing.update(user=user_id, last_registered=now)
+
+    new_devices = [device for device in devices if device not in registered]
+    try:
+        with transaction.atomic():
+            Device.objects.bulk_create([
+                Device(key=key, type=device_type, user_id=user_id,
+                       last_registered=now)
+                for key, device_type in new_devices
+            ])
+    except IntegrityError:
+        # Some were registered concurrently, insert them one at a time
+        for key, device_type in new_devices:
+            try:
+                with transaction.atomic():
+                    Device.objects.create(key=key, type=device_type,
+                                          user_id=user_id,
+                                          last_registered=now)
+            except IntegrityError:
+                Device.objects.filter(key=key, type=device_type).update(
+                    user=user_id,
+                    last_registered=now
+                )
+
+
+def update_devices_last_success(device_ids, resolution=None):
+    # Record that devices were reached, devices reached less than
+    # `resolution` ago are left alone to spare rewriting their rows
+    now = timezone.now()
+    for ids in _chunks(device_ids, BULK_QUERY_BATCH_SIZE):
+        devices = Device.objects.filter(id__in=ids)
+        if resolution:
+            devices = devices.filter(
+                models.Q(last_success__isnull=True) |
+                models.Q(last_success__lt=now - resolution)
+            )
+        devices.update(last_success=now)
+
+
+def get_stale_devices(max_idle):
+    # Devices neither registered nor reached within `max_idle`
+    stale_before = timezone.now() - max_idle
+    return Device.objects.filter(
+        models.Q(last_success__isnull=True) |
+        models.Q(last_success__lt=stale_before),
+        last_registered__lt=stale_before
+    )
+
+
+def unregister_devices(keys):
+    # Delete the devices of the given keys, returning the keys found
+    found_keys = set()
+    device_ids = []
+    for batch in _chunks(set(keys), BULK_QUERY_BATCH_SIZE):
+        for device_id, key in Device.objects.filter(
+                key__in=batch).values_list('id', 'key'):
+            device_ids.append(device_id)
+            found_keys.add(key)
+
+    delete_devices(device_ids)
+    return found_keys
+
+
+def get_devices_by_ids(device_ids):
+    devices = []
+    for ids in _chunks(device_ids, BULK_QUERY_BATCH_SIZE):
+        devices.extend(get_device_records(
+            Device.objects.filter(id__in=ids).order_by('id')
+        ))
     return devices
+
+
+def raw_delete(queryset):
+    # Delete without loading the rows or collecting their related rows,
+    # QuerySet._raw_delete is missing before Django 1.9
+    if hasattr(queryset, '_raw_delete'):
+        queryset._raw_delete(queryset.db)
+    else:
+        queryset.delete()
+
+
+def purge_rows(queryset, batch_size=BULK_QUERY_BATCH_SIZE, deadline=None,
+               dependents=()):
+    # Delete the rows of a queryset in batches of primary keys so that
+    # no statement locks more than `batch_size` rows. `dependents` are
+    # (model, field) pairs of rows pointing to the queryset's rows, they
+    # are deleted first so that nothing is left pointing to a deleted row
+    # when the deadline is hit. Stops early once time.time() passes
+    # `deadline`, returns whether every row was deleted.
+    while deadline is None or time.time() < deadline:
+        ids = list(queryset.order_by('pk').values_list(
+            'pk', flat=True
+        )[:batch_size])
+        if not ids:
+            return True
+
+        for model, field in dependents:
+            if not purge_rows(
+                    model.objects.filter(**{'{}__in'.format(field): ids}),
+                    batch_size, deadline):
+                return False
+
+        raw_delete(queryset.model.objects.filter(pk__in=ids))
+        if len(ids) < batch_size:
+            return True
+
+    return False
+
+
+def purge_push_notifications(notifications, batch_size=BULK_QUERY_BATCH_SIZE,
+                             deadline=None):
+    return purge_rows(notifications, batch_size, deadline, dependents=(
+        (PushNotificationTarget, 'notification_id'),
+        (DeadLetter, 'notification_id'),
+        (PushDelivery, 'notification_id')
+    ))
+
+
+def purge_devices(devices, batch_size=BULK_QUERY_BATCH_SIZE, deadline=None):
+    # Delivery records are kept, they outlive their devices
+    return purge_rows(devices, batch_size, deadline, dependents=(
+        (DeadLetter, 'device_id'),
+    ))
@@ -0,0 +1,86 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class RateLimiter(object):
+    """Limit the number of messages sent per second across all workers.
+
+    Messages are counted in one second windows stored in Django's cache,
+    using only ``add`` and ``incr`` so the count stays consistent between
+    processes with any shared backend (Redis, Memcached...). Callers
+    asking for more than what is left in the current window wait for the
+    next one.
+    """
+    def __init__(self, name, rate, cache_alias='default'):
+        self.name = name
+        self.rate = int(rate)
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def window_key(self, window):
+        return 'pushy:ratelimit:{}:{}'.format(self.name, window)
+
+    def _take(self, count):
+        # Take up to `count` messages from the current window,
+        # returns how many were granted
+        window = int(time.time())
+        key = self.window_key(window)
+
+        self.cache.add(key, 0, timeout=2)
+        try:
+            used = self.cache.incr(key, count)
+        except ValueError:
+            # The window expired between add and incr
+            return 0
+
+        if used <= self.rate:
+            return count
+
+        # Give back what doesn't fit in this window
+        granted = max(0, count - (used - self.rate))
+        self.cache.decr(key, count - granted)
+        return granted
+
+    def acquire(self, count=1):
+        """Block until `count` messages may be sent.
+
+        Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+
+        while count > 0:
+            count -= self._take(count)
+            if count > 0:
+                delay = 1 - (time.time() % 1)
+                time.sleep(delay)
+                waited += delay
+
+        return waited
+
+
+def get_rate_limiter(provider, credential):
+    """Return the rate limiter configured for a provider, if any.
+
+    Limits are set in messages per second with ``PUSHY_RATE_LIMITS``,
+    for example ``{'gcm': 1000, 'apns': 500}``, and apply to every worker
+    sending with the same credential.
+    """
+    rate = getattr(settings, 'PUSHY_RATE_LIMITS', {}).get(provider)
+    if not rate:
+        return None
+
+    credential_hash = hashlib.md5(
+        str(credential).encode('utf-8')
+    ).hexdigest()
+
+    return RateLimiter(
+        '{}:{}'.format(provider, credential_hash),
+        rate,
+        cache_alias=getattr(settings, 'PUSHY_RATE_LIMIT_CACHE', 'default')
+    )
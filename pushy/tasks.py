@@ -1,84 +1,713 @@
 import datetime
+import hashlib
+import json
 import logging
+import os
+import random
+import threading
+import time
+
+from collections import OrderedDict
 
 import celery
 
 from django.conf import settings
-from django.db import transaction
-from django.db.utils import IntegrityError
+from django.core.exceptions import ImproperlyConfigured
 from django.utils import timezone
+from django.db.models import F
+from django.utils.encoding import force_text
 
 from .models import (
     PushNotification,
     Device,
-    get_filtered_devices_queryset
+    DeadLetter,
+    PushDelivery,
+    PushDeliveryBuffer,
+    get_filtered_devices_queryset,
+    get_devices_id_ranges,
+    get_audience_size,
+    get_devices_in_range,
+    get_devices_by_ids,
+    get_device_records,
+    update_devices_keys,
+    update_devices_last_success,
+    delete_devices,
+    get_stale_devices,
+    purge_devices,
+    purge_push_notifications,
+    purge_rows
 )
 from .exceptions import (
     PushInvalidTokenException,
+    PushServerException,
     PushException
 )
-from .dispatchers import get_dispatcher
+from .dispatchers import get_dispatcher, get_thread_dispatcher
+from .instrumentation import get_instrumentation
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    ThreadPoolExecutor = None
 
 
 logger = logging.getLogger(__name__)
 
+executor = None
+executor_pid = None
+
+# Payloads of the notifications recently sent by this worker,
+# keyed by (notification id, payload hash)
+payloads_cache = OrderedDict()
+payloads_cache_lock = threading.Lock()
+
 
 @celery.shared_task(
     queue=getattr(settings, 'PUSHY_QUEUE_DEFAULT_NAME', None)
 )
 def check_pending_push_notifications():
+    batch_size = getattr(settings, 'PUSHY_PENDING_BATCH_SIZE', 100)
     pending_notifications = PushNotification.objects.filter(
         sent=PushNotification.PUSH_NOT_SENT
-    )
+    ).order_by('id')[:batch_size]
 
     for pending_notification in pending_notifications:
-        create_push_notification_groups.apply_async(kwargs={
-            'notification': pending_notification.to_dict()
-        })
+        if not claim_push_notification(pending_notification):
+            continue
+
+        try:
+            create_push_notification_groups.apply_async(kwargs={
+                'notification': pending_notification.to_dict()
+            })
+        except Exception:
+            release_push_notification(pending_notification)
+            raise
+
+
+def claim_push_notification(notification):
+    # Conditionally move the notification out of the pending state, only
+    # one of several concurrent schedulers can succeed for a notification
+    date_started = timezone.now()
+    claimed = PushNotification.objects.filter(
+        pk=notification.pk,
+        sent=PushNotification.PUSH_NOT_SENT
+    ).update(
+        sent=PushNotification.PUSH_IN_PROGRESS,
+        date_started=date_started
+    )
+
+    if claimed:
+        notification.sent = PushNotification.PUSH_IN_PROGRESS
+        notification.date_started = date_started
+
+    return bool(claimed)
+
+
+def release_push_notification(notification):
+    # Give back a claim whose coordinator couldn't be queued so that
+    # check_pending_push_notifications picks the notification up again
+    released = PushNotification.objects.filter(
+        pk=notification.pk,
+        sent=PushNotification.PUSH_IN_PROGRESS,
+        remaining_groups=0
+    ).update(
+        sent=PushNotification.PUSH_NOT_SENT,
+        date_started=None
+    )
+
+    if released:
+        notification.sent = PushNotification.PUSH_NOT_SENT
+        notification.date_started = None
+
+    return bool(released)
 
 
 @celery.shared_task(
-    queue=getattr(settings, 'PUSHY_QUEUE_DEFAULT_NAME', None)
+    queue=getattr(settings, 'PUSHY_QUEUE_DEFAULT_NAME', None),
+    ignore_result=True
 )
 def create_push_notification_groups(notification):
+    # Split the audience into ranges of PUSHY_FANOUT_SIZE chunks and hand
+    # every range to a sub-coordinator as soon as its boundary is found,
+    # sub-coordinators queue the chunks of their range
     devices = get_filtered_devices_queryset(notification)
 
     date_started = timezone.now()
 
-    if devices.count() > 0:
-        count = devices.count()
-        limit = getattr(settings, 'PUSHY_DEVICE_KEY_LIMIT', 1000)
-        celery.chord(
-            send_push_notification_group.s(notification, offset, limit)
-            for offset in range(0, count, limit)
-        )(notify_push_notification_sent.si(notification))
+    limit = getattr(settings, 'PUSHY_DEVICE_KEY_LIMIT', 1000)
+    fanout = getattr(settings, 'PUSHY_FANOUT_SIZE', 100)
+
+    if notification['id']:
+        # remaining_groups starts with a token held by this task so that
+        # the notification can't complete before every range is queued.
+        # Notifications already fanned out or sent are left alone when the
+        # task is delivered again.
+        updated = PushNotification.objects.filter(
+            pk=notification['id'],
+            remaining_groups=0
+        ).exclude(
+            sent=PushNotification.PUSH_SENT
+        ).update(
+            sent=PushNotification.PUSH_IN_PROGRESS,
+            date_started=date_started,
+            audience_size=0,
+            remaining_groups=1
+        )
+        if not updated:
+            return
 
-    if not notification['id']:
-        return
+    try:
+        for after_id, until_id in get_devices_id_ranges(devices,
+                                                        limit * fanout):
+            if notification['id']:
+                add_push_notification_groups(notification['id'], 1)
+            create_push_notification_chunks.apply_async(kwargs={
+                'notification': get_notification_message(notification),
+                'after_id': after_id,
+                'until_id': until_id
+            })
+    finally:
+        if notification['id']:
+            finish_push_notification_group(notification['id'])
+
+
+@celery.shared_task(
+    queue=getattr(settings, 'PUSHY_QUEUE_DEFAULT_NAME', None),
+    ignore_result=True
+)
+def create_push_notification_chunks(notification, after_id=0, until_id=None):
+    instrumentation = get_instrumentation()
+    devices = get_filtered_devices_queryset(notification)
+    limit = getattr(settings, 'PUSHY_DEVICE_KEY_LIMIT', 1000)
 
     try:
-        notification = PushNotification.objects.get(pk=notification['id'])
-        notification.sent = PushNotification.PUSH_IN_PROGRESS
-        notification.date_started = date_started
-        notification.save()
-    except PushNotification.DoesNotExist:
-        return
+        with instrumentation.timer('groups.plan'):
+            id_ranges = list(get_devices_id_ranges(
+                devices, limit, after_id, until_id
+            ))
+            audience_size = get_audience_size(
+                devices,
+                id_ranges,
+                limit,
+                exact=getattr(settings, 'PUSHY_AUDIENCE_SIZE_EXACT', True)
+            )
+        instrumentation.incr('groups.chunks', len(id_ranges))
+
+        if notification['id']:
+            add_push_notification_groups(
+                notification['id'],
+                len(id_ranges),
+                audience_size
+            )
+
+        queued_at = time.time()
+        celery.group(
+            send_push_notification_chunk.si(
+                notification, chunk_after_id, chunk_until_id,
+                queued_at=queued_at
+            )
+            for chunk_after_id, chunk_until_id in id_ranges
+        ).apply_async()
+    finally:
+        # Give back the token the coordinator took for this range
+        if notification['id']:
+            finish_push_notification_group(notification['id'])
+
+
+def create_push_notification_device_chunks(notification, device_ids):
+    # Split an explicit list of devices into chunks of
+    # PUSHY_DEVICE_KEY_LIMIT devices, every chunk is a group
+    # of the notification loading its devices in batches of ids
+    limit = getattr(settings, 'PUSHY_DEVICE_KEY_LIMIT', 1000)
+    chunks = [
+        device_ids[pos:pos + limit]
+        for pos in range(0, len(device_ids), limit)
+    ]
+
+    if notification['id']:
+        add_push_notification_groups(
+            notification['id'],
+            len(chunks),
+            len(device_ids)
+        )
+        if not chunks:
+            mark_push_notification_sent(notification['id'])
+
+    message = get_notification_message(notification)
+    celery.group(
+        send_push_notification_devices.si(message, chunk, finish_group=True)
+        for chunk in chunks
+    ).apply_async()
+
+    return len(chunks)
+
+
+def get_payload_hash(payload):
+    return hashlib.md5(
+        json.dumps(payload, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+def get_notification_message(notification):
+    # Chunk tasks get the notification id, a hash of its payload and its
+    # filters instead of the whole notification, the payload is loaded once
+    # per worker by resolve_notification. Notifications which weren't
+    # stored have to be sent whole.
+    if not notification.get('id'):
+        return notification
+
+    return {
+        'id': notification['id'],
+        'payload_hash': get_payload_hash(notification['payload']),
+        'filter_type': notification.get('filter_type', 0),
+        'filter_user': notification.get('filter_user', 0),
+        'filter_types': notification.get('filter_types', ''),
+        'filter_targets': notification.get('filter_targets', False)
+    }
+
+
+def resolve_notification(notification):
+    # Add the payload to a message made by get_notification_message.
+    # Messages without a payload hash, such as replayed dead letters,
+    # load the payload without going through the cache.
+    if 'payload' in notification:
+        return notification
+
+    key = None
+    payload = None
+    if notification.get('payload_hash'):
+        key = (notification['id'], notification['payload_hash'])
+        with payloads_cache_lock:
+            payload = payloads_cache.pop(key, None)
+            if payload is not None:
+                payloads_cache[key] = payload
+
+    if payload is None:
+        body = PushNotification.objects.filter(
+            pk=notification['id']
+        ).values_list('body', flat=True).first()
+        if body is None:
+            raise PushNotification.DoesNotExist(
+                'Notification {} does not exist'.format(notification['id'])
+            )
+        payload = PushNotification(body=body).payload
+
+    if key is not None:
+        with payloads_cache_lock:
+            payloads_cache[key] = payload
+            while len(payloads_cache) > getattr(
+                    settings, 'PUSHY_PAYLOAD_CACHE_SIZE', 128):
+                payloads_cache.popitem(last=False)
+
+    notification = dict(notification)
+    notification['payload'] = payload
+    return notification
+
+
+def add_push_notification_groups(notification_id, count, audience_size=0):
+    PushNotification.objects.filter(pk=notification_id).update(
+        remaining_groups=F('remaining_groups') + count,
+        audience_size=F('audience_size') + audience_size
+    )
+
+
+def mark_push_notification_sent(notification_id):
+    # Only the first caller finding no remaining groups marks
+    # the notification as sent
+    return bool(PushNotification.objects.filter(
+        pk=notification_id,
+        sent=PushNotification.PUSH_IN_PROGRESS,
+        remaining_groups=0
+    ).update(
+        sent=PushNotification.PUSH_SENT,
+        date_finished=timezone.now()
+    ))
+
+
+def finish_push_notification_group(notification_id):
+    # Count the group as done and mark the notification as sent
+    # once every group of the notification is done
+    PushNotification.objects.filter(
+        pk=notification_id,
+        remaining_groups__gt=0
+    ).update(remaining_groups=F('remaining_groups') - 1)
+
+    return mark_push_notification_sent(notification_id)
+
+
+@celery.shared_task(
+    queue=getattr(settings, 'PUSHY_QUEUE_DEFAULT_NAME', None),
+    ignore_result=True
+)
+def send_push_notification_chunk(notification, after_id=0, until_id=None,
+                                 queued_at=None):
+    instrumentation = get_instrumentation()
+    if queued_at:
+        instrumentation.timing('group.queue_wait', time.time() - queued_at)
+
+    try:
+        try:
+            notification = resolve_notification(notification)
+        except PushNotification.DoesNotExist:
+            logger.exception("Notification {} does not exist".format(
+                notification['id']
+            ))
+            return False
+
+        with instrumentation.timer('group.send'):
+            devices = get_filtered_devices_queryset(notification)
+
+            devices = get_device_records(
+                get_devices_in_range(devices, after_id, until_id)
+            )
+
+            send_push_notification_to_devices(notification, devices)
+    finally:
+        # A failed group must not keep the notification in progress
+        if notification['id']:
+            finish_push_notification_group(notification['id'])
+
+    return True
 
 
 @celery.shared_task(
     queue=getattr(settings, 'PUSHY_QUEUE_DEFAULT_NAME', None)
 )
 def send_push_notification_group(notification, offset=0, limit=1000):
-    devices = get_filtered_devices_queryset(notification)
+    # Chunks are sent by send_push_notification_chunk, this task keeps
+    # running the offset based chord headers queued by previous versions.
+    # Their notify_push_notification_sent callback marks them as sent.
+    devices = get_filtered_devices_queryset(notification).order_by('pk')
+
+    send_push_notification_to_devices(
+        notification,
+        get_device_records(devices[offset:offset + limit])
+    )
 
-    devices = devices[offset:offset + limit]
+    return True
 
-    for device in devices:
-        send_single_push_notification(device, notification['payload'])
+
+@celery.shared_task(
+    queue=getattr(settings, 'PUSHY_QUEUE_DEFAULT_NAME', None),
+    ignore_result=True
+)
+def send_push_notification_devices(notification, device_ids, attempt=0,
+                                   finish_group=False):
+    # Send to an explicit list of devices, used by bulk sends and to retry
+    # failed sends. Only bulk sends count as a group of the notification.
+    try:
+        try:
+            notification = resolve_notification(notification)
+        except PushNotification.DoesNotExist:
+            logger.exception("Notification {} does not exist".format(
+                notification['id']
+            ))
+            return False
+
+        devices = get_devices_by_ids(device_ids)
+
+        send_push_notification_to_devices(notification, devices, attempt)
+    finally:
+        if finish_group and notification['id']:
+            finish_push_notification_group(notification['id'])
 
     return True
 
 
+def send_push_notification_to_devices(notification, devices, attempt=0):
+    devices_by_type = {}
+    for device in devices:
+        devices_by_type.setdefault(device.type, []).append(device)
+
+    canonical_ids = []
+    invalid_ids = []
+    failures = []
+    deliveries = None
+    if getattr(settings, 'PUSHY_DELIVERY_LOG', False):
+        deliveries = PushDeliveryBuffer(
+            notification['id'],
+            getattr(settings, 'PUSHY_DELIVERY_LOG_BUFFER_SIZE', 1000)
+        )
+
+    results = dispatch_push_notification_batches(
+        devices_by_type,
+        notification['payload']
+    )
+    for batch_canonical_ids, batch_invalid_ids, batch_failures, \
+            batch_deliveries in results:
+        canonical_ids.extend(batch_canonical_ids)
+        invalid_ids.extend(batch_invalid_ids)
+        failures.extend(batch_failures)
+        if deliveries is not None:
+            deliveries.extend(batch_deliveries)
+
+    # Apply the outcome of the whole chunk in a few bulk statements
+    # rather than writing to the database after every single send
+    with get_instrumentation().timer('group.bookkeeping'):
+        failed_ids = set(invalid_ids)
+        failed_ids.update(device_id for device_id, exc in failures)
+        update_devices_last_success(
+            [device.id
+             for devices in devices_by_type.values()
+             for device in devices
+             if device.id not in failed_ids],
+            getattr(settings, 'PUSHY_DEVICE_LAST_SUCCESS_RESOLUTION',
+                    datetime.timedelta(hours=1))
+        )
+
+        invalid_ids.extend(update_devices_keys(canonical_ids))
+        delete_devices(invalid_ids)
+        if deliveries is not None:
+            deliveries.flush()
+
+        if failures:
+            handle_push_notification_failures(notification, failures, attempt)
+
+
+def get_retry_delay(attempt, retry_after=None):
+    base_delay = getattr(settings, 'PUSHY_RETRY_BASE_DELAY', 10)
+    max_delay = getattr(settings, 'PUSHY_RETRY_MAX_DELAY', 3600)
+
+    delay = min(max_delay, base_delay * (2 ** attempt))
+    # Jitter keeps chunks which failed together from retrying together
+    delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    return max(delay, retry_after or 0)
+
+
+def handle_push_notification_failures(notification, failures, attempt=0):
+    # Retry devices which failed because of the provider with a single
+    # delayed task, everything else goes to the dead letters
+    max_retries = getattr(settings, 'PUSHY_MAX_RETRIES', 5)
+    retry_ids = []
+    retry_after = 0
+    dead_letters = []
+
+    for device_id, exc in failures:
+        if isinstance(exc, PushServerException) and attempt < max_retries:
+            retry_ids.append(device_id)
+            retry_after = max(retry_after, exc.retry_after or 0)
+            continue
+
+        # The payload of stored notifications is loaded again on replay,
+        # only notifications which weren't stored keep a copy
+        dead_letter = DeadLetter(
+            notification_id=notification['id'],
+            device_id=device_id,
+            error=exc.__class__.__name__,
+            attempts=attempt + 1
+        )
+        if not notification['id']:
+            dead_letter.payload = notification['payload']
+        dead_letters.append(dead_letter)
+
+    if retry_ids:
+        send_push_notification_devices.apply_async(
+            kwargs={
+                'notification': get_notification_message(notification),
+                'device_ids': retry_ids,
+                'attempt': attempt + 1
+            },
+            countdown=get_retry_delay(attempt, retry_after)
+        )
+
+    if dead_letters:
+        DeadLetter.objects.bulk_create(dead_letters)
+
+
+def get_executor(max_workers):
+    # Threads are kept for the life of the worker process so that their
+    # dispatchers and connections are reused across chunks
+    global executor, executor_pid
+
+    if ThreadPoolExecutor is None:
+        raise ImproperlyConfigured(
+            'PUSHY_DISPATCH_THREADS requires concurrent.futures, '
+            'install the futures package on Python 2'
+        )
+
+    if executor is None or executor_pid != os.getpid():
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        executor_pid = os.getpid()
+
+    return executor
+
+
+def prepare_payloads(device_types, payload):
+    # Compile the payload once per provider for the whole chunk,
+    # returns the prepared payloads and the errors of those which failed
+    payloads = {}
+    errors = {}
+
+    for device_type in device_types:
+        try:
+            payloads[device_type] = get_dispatcher(device_type).prepare(
+                payload
+            )
+        except PushException as exc:
+            logger.exception(
+                "Push notification payload can't be sent to devices "
+                "of type {}".format(device_type)
+            )
+            errors[device_type] = exc
+
+    return payloads, errors
+
+
+def dispatch_push_notification_batches(devices_by_type, payload):
+    max_workers = getattr(settings, 'PUSHY_DISPATCH_THREADS', None)
+    payloads, errors = prepare_payloads(devices_by_type.keys(), payload)
+
+    results = []
+    for device_type, exc in errors.items():
+        devices = devices_by_type[device_type]
+        failures = [(device.id, exc) for device in devices]
+        results.append(
+            ([], [], failures, get_delivery_records(devices, [], failures))
+        )
+    devices_by_type = dict(
+        (device_type, devices)
+        for device_type, devices in devices_by_type.items()
+        if device_type in payloads
+    )
+
+    if not max_workers:
+        return results + [
+            send_push_notification_batch(
+                device_type,
+                devices,
+                payloads[device_type]
+            )
+            for device_type, devices in devices_by_type.items()
+        ]
+
+    # Spread the chunk over the thread pool, each thread sending
+    # its batches through its own dispatcher
+    batch_size = getattr(settings, 'PUSHY_DISPATCH_THREAD_BATCH_SIZE', 100)
+    batches = [
+        (device_type, devices[pos:pos + batch_size])
+        for device_type, devices in devices_by_type.items()
+        for pos in range(0, len(devices), batch_size)
+    ]
+
+    return results + list(get_executor(max_workers).map(
+        lambda batch: send_push_notification_batch(
+            batch[0],
+            batch[1],
+            payloads[batch[0]],
+            dispatcher=get_thread_dispatcher(batch[0])
+        ),
+        batches
+    ))
+
+
+def get_delivery_records(devices, invalid_ids, failures, latency=None):
+    # Build the (device_id, status, error, latency) records of a batch
+    # for the delivery log, nothing is recorded unless it is enabled
+    if not getattr(settings, 'PUSHY_DELIVERY_LOG', False):
+        return []
+
+    invalid_ids = set(invalid_ids)
+    errors = dict(failures)
+    records = []
+    for device in devices:
+        if device.id in invalid_ids:
+            records.append((
+                device.id, PushDelivery.DELIVERY_INVALID,
+                PushInvalidTokenException.__name__, latency
+            ))
+        elif device.id in errors:
+            records.append((
+                device.id, PushDelivery.DELIVERY_FAILED,
+                errors[device.id].__class__.__name__, latency
+            ))
+        else:
+            records.append((
+                device.id, PushDelivery.DELIVERY_SENT, '', latency
+            ))
+
+    return records
+
+
+def send_push_notification_batch(device_type, devices, payload,
+                                 dispatcher=None):
+    # Deliver a single payload to devices of the same type using
+    # as few provider requests as possible. Returns a list of
+    # (device_id, device_type, canonical_id) tuples, a list of device ids
+    # with invalid tokens, a list of (device_id, exception) tuples for
+    # the devices which could not be sent to and the delivery log records.
+    if dispatcher is None:
+        dispatcher = get_dispatcher(device_type)
+    devices_by_key = dict((device.key, device) for device in devices)
+    canonical_ids = []
+    invalid_ids = []
+    failures = []
+
+    instrumentation = get_instrumentation()
+    started = time.time()
+    try:
+        provider_canonical_ids, errors = dispatcher.send_batch(
+            list(devices_by_key.keys()),
+            payload
+        )
+    except PushException as exc:
+        latency = time.time() - started
+        instrumentation.timing(
+            '{}.latency'.format(dispatcher.provider),
+            latency
+        )
+        instrumentation.incr(
+            '{}.error'.format(dispatcher.provider),
+            len(devices)
+        )
+        logger.exception("An error occured while sending push notification")
+        failures = [(device.id, exc) for device in devices]
+        return canonical_ids, invalid_ids, failures, get_delivery_records(
+            devices, invalid_ids, failures, latency
+        )
+    latency = time.time() - started
+    instrumentation.timing('{}.latency'.format(dispatcher.provider), latency)
+
+    for device_key, exc in errors.items():
+        device = devices_by_key[device_key]
+        if isinstance(exc, PushInvalidTokenException):
+            logger.debug('Token for device {} does not exist, skipping'.format(
+                device.id
+            ))
+            invalid_ids.append(device.id)
+        else:
+            logger.error(
+                'An error occured while sending push notification '
+                'to device {}: {!r}'.format(device.id, exc)
+            )
+            failures.append((device.id, exc))
+
+    for device_key, canonical_id in provider_canonical_ids.items():
+        if device_key in errors:
+            continue
+        device = devices_by_key[device_key]
+        canonical_ids.append(
+            (device.id, device.type, force_text(canonical_id))
+        )
+
+    instrumentation.incr(
+        '{}.sent'.format(dispatcher.provider),
+        len(devices) - len(errors)
+    )
+    instrumentation.incr(
+        '{}.invalid'.format(dispatcher.provider),
+        len(invalid_ids)
+    )
+    instrumentation.incr(
+        '{}.error'.format(dispatcher.provider),
+        len(failures)
+    )
+
+    return canonical_ids, invalid_ids, failures, get_delivery_records(
+        devices, invalid_ids, failures, latency
+    )
+
+
 @celery.shared_task(
     queue=getattr(settings, 'PUSHY_QUEUE_DEFAULT_NAME', None)
 )
@@ -93,25 +722,32 @@ def send_single_push_notification(device, payload):
             return False
 
     dispatcher = get_dispatcher(device.type)
+    instrumentation = get_instrumentation()
 
     try:
-        canonical_id = dispatcher.send(device.key, payload)
+        with instrumentation.timer('{}.latency'.format(dispatcher.provider)):
+            canonical_id = dispatcher.send(device.key, payload)
+        instrumentation.incr('{}.sent'.format(dispatcher.provider))
         if not canonical_id:
             return
 
-        with transaction.atomic():
-            device.key = canonical_id
-            device.save()
+        delete_devices(update_devices_keys([
+            (device.id, device.type, force_text(canonical_id))
+        ]))
 
-    except IntegrityError:
-        device.delete()
     except PushInvalidTokenException:
+        instrumentation.incr('{}.invalid'.format(dispatcher.provider))
         logger.debug('Token for device {} does not exist, skipping'.format(
             device.id
         ))
         device.delete()
-    except PushException:
+    except PushException as exc:
+        instrumentation.incr('{}.error'.format(dispatcher.provider))
         logger.exception("An error occured while sending push notification")
+        handle_push_notification_failures(
+            {'id': None, 'payload': payload},
+            [(device.id, exc)]
+        )
         return
 
 
@@ -119,6 +755,8 @@ def send_single_push_notification(device, payload):
     queue=getattr(settings, 'PUSH_QUEUE_DEFAULT_NAME', None),
 )
 def notify_push_notification_sent(notification):
+    # Completion is tracked with remaining_groups, this task is kept for
+    # chords queued by previous versions
     if not notification['id']:
         return False
 
@@ -142,7 +780,58 @@ def clean_sent_notifications():
         raise ValueError('Notification max age value is not defined.')
 
     delete_before_date = timezone.now() - max_age
-    PushNotification.objects.filter(
+    notifications = PushNotification.objects.filter(
         sent=PushNotification.PUSH_SENT,
         date_finished__lt=delete_before_date
-    ).delete()
+    )
+
+    # Rows are deleted in batches of PUSHY_PURGE_BATCH_SIZE, the rest is
+    # left for the next run once PUSHY_PURGE_TIME_LIMIT seconds have passed
+    batch_size, deadline = get_purge_options()
+
+    # Delivery logs go with their notification, logs of single sends
+    # are kept for as long as notifications are
+    finished = purge_push_notifications(notifications, batch_size, deadline)
+    finished = purge_rows(
+        PushDelivery.objects.filter(
+            date_created__lt=timezone.now() - getattr(
+                settings, 'PUSHY_DELIVERY_LOG_MAX_AGE', max_age
+            )
+        ),
+        batch_size,
+        deadline
+    ) and finished
+
+    if not finished:
+        logger.info('Purge time limit reached, the remaining rows are '
+                    'deleted by the next run')
+
+    return finished
+
+
+def get_purge_options():
+    # Batch size and deadline of the purging tasks
+    batch_size = getattr(settings, 'PUSHY_PURGE_BATCH_SIZE', 500)
+    time_limit = getattr(settings, 'PUSHY_PURGE_TIME_LIMIT', None)
+    deadline = time.time() + time_limit if time_limit else None
+    return batch_size, deadline
+
+
+@celery.shared_task(
+    queue=getattr(settings, 'PUSHY_QUEUE_DEFAULT_NAME', None)
+)
+def prune_stale_devices():
+    max_idle = getattr(settings, 'PUSHY_DEVICE_MAX_IDLE', None)
+
+    if not max_idle or not isinstance(max_idle, datetime.timedelta):
+        raise ValueError('Device max idle value is not defined.')
+
+    batch_size, deadline = get_purge_options()
+    finished = purge_devices(get_stale_devices(max_idle), batch_size,
+                             deadline)
+
+    if not finished:
+        logger.info('Purge time limit reached, the remaining stale devices '
+                    'are deleted by the next run')
+
+    return finished
@@ -1,38 +1,126 @@
-from .models import PushNotification
+from django.conf import settings
+from django.utils import timezone
+
+from .models import (
+    DeadLetter,
+    PushNotification,
+    create_push_notification_targets
+)
 from .tasks import (
-    send_single_push_notification,
-    create_push_notification_groups
+    send_push_notification_devices,
+    create_push_notification_device_chunks,
+    create_push_notification_groups,
+    release_push_notification
 )
 
 
 def send_push_notification(title, payload, device=None,
                            filter_user=None, filter_type=None,
-                           store=True):
+                           store=True, filter_users=None, filter_types=None):
 
     if not filter_type:
         filter_type = 0
     if not filter_user:
         filter_user = 0
+    if filter_users is not None and not store:
+        raise ValueError('Notifications sent to several users must be stored')
 
+    if device:
+        # Send a single push notification immediately
+        return send_push_notification_bulk(title, payload, [device],
+                                           store=store)
+
+    # The notification is dispatched right away, store it as in progress
+    # so that check_pending_push_notifications doesn't send it again
     notification = PushNotification(
         title=title,
         payload=payload,
         active=PushNotification.PUSH_ACTIVE,
-        sent=PushNotification.PUSH_NOT_SENT,
+        sent=PushNotification.PUSH_IN_PROGRESS,
+        date_started=timezone.now(),
         filter_user=filter_user,
         filter_type=filter_type
     )
+    notification.device_types = filter_types
     if store:
         notification.save()
+    if filter_users is not None:
+        create_push_notification_targets(notification, filter_users)
 
-    if device:
-        # Send a single push notification immediately
-        send_single_push_notification.apply_async(kwargs={
-            'device': device.id,
-            'notification': notification.to_dict()
-        })
-        return notification
+    try:
+        create_push_notification_groups.delay(
+            notification=notification.to_dict()
+        )
+    except Exception:
+        if store:
+            release_push_notification(notification)
+        raise
+
+    return notification
+
+
+def send_push_notification_bulk(title, payload, devices, store=True):
+    # Send to a list of devices or device ids through chunks of
+    # PUSHY_DEVICE_KEY_LIMIT devices, each loading its devices in batches
+    # of ids rather than one query per device
+    device_ids = sorted(set(
+        getattr(device, 'id', device) for device in devices
+    ))
+
+    notification = PushNotification(
+        title=title,
+        payload=payload,
+        active=PushNotification.PUSH_ACTIVE,
+        sent=PushNotification.PUSH_IN_PROGRESS,
+        date_started=timezone.now(),
+        audience_size=0
+    )
+    if store:
+        notification.save()
 
-    create_push_notification_groups.delay(notification=notification.to_dict())
+    create_push_notification_device_chunks(
+        notification.to_dict(),
+        device_ids
+    )
 
     return notification
+
+
+def replay_dead_letters(dead_letters=None):
+    # Send dead letters again, grouping devices which failed the same
+    # notification into as few tasks as possible
+    if dead_letters is None:
+        dead_letters = DeadLetter.objects.all()
+
+    limit = getattr(settings, 'PUSHY_DEVICE_KEY_LIMIT', 1000)
+    devices_by_notification = {}
+    dead_letter_ids = []
+    for dead_letter in dead_letters:
+        devices_by_notification.setdefault(
+            (dead_letter.notification_id, dead_letter.body), []
+        ).append(dead_letter.device_id)
+        dead_letter_ids.append(dead_letter.id)
+
+    for (notification_id, body), device_ids in \
+            devices_by_notification.items():
+        if body:
+            notification = {
+                'id': notification_id,
+                'payload': DeadLetter(body=body).payload
+            }
+        else:
+            # Resolved from the stored notification by the task
+            notification = {'id': notification_id}
+        for pos in range(0, len(device_ids), limit):
+            send_push_notification_devices.delay(
+                notification=notification,
+                device_ids=device_ids[pos:pos + limit]
+            )
+
+    # Devices failing again are stored as new dead letters
+    for pos in range(0, len(dead_letter_ids), limit):
+        DeadLetter.objects.filter(
+            id__in=dead_letter_ids[pos:pos + limit]
+        ).delete()
+
+    return len(dead_letter_ids)
@@ -11,6 +11,7 @@ setup(
         'pushy',
         'pushy/contrib',
         'pushy/contrib/rest_api',
+        'pushy/contrib/aio',
         'pushy/migrations',
     ],
     include_package_data=True,
@@ -29,6 +30,8 @@ setup(
         'pushjack==1.3.0'
     ],
     extras_require={
-        'rest_api': ['djangorestframework<3.7.0']
+        'rest_api': ['djangorestframework<3.7.0'],
+        'aio': ['aiohttp>=3.3'],
+        'threads': ['futures; python_version < "3"']
     }
 )
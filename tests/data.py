@@ -7,7 +7,10 @@ class ResponseMock:
     def __init__(self, status_code):
         self.status_code = status_code
         self.errors = []
+        self.failures = []
         self.canonical_ids = []
+        self.responses = []
+        self.messages = []
 
 
 def valid_response():
@@ -25,3 +28,21 @@ def invalid_with_exception(exc):
     response = ResponseMock(400)
     response.errors.append(exc)
     return response
+
+
+def batch_response(canonical_ids=None, errors=None):
+    response = ResponseMock(200)
+    for old_id, new_id in (canonical_ids or {}).items():
+        response.canonical_ids.append(GCMCanonicalID(old_id, new_id))
+    for exc in errors or []:
+        response.errors.append(exc)
+        response.failures.append(exc.identifier)
+    return response
+
+
+def apns_batch_response(token_errors=None):
+    response = ResponseMock(200)
+    response.token_errors = dict(token_errors or {})
+    response.errors = list(response.token_errors.values())
+    response.failures = list(response.token_errors.keys())
+    return response
@@ -0,0 +1,281 @@
+import json
+import random
+import socket
+import struct
+import threading
+import time
+
+from binascii import hexlify
+from contextlib import contextmanager
+
+from pushjack.apns import APNSConnection
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import (
+        BaseRequestHandler,
+        ThreadingMixIn,
+        TCPServer
+    )
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import BaseRequestHandler, ThreadingMixIn, TCPServer
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeGCMHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server.fake_server
+        length = int(self.headers.get('Content-Length', 0))
+        message = json.loads(self.rfile.read(length).decode('utf-8'))
+
+        if 'registration_ids' in message:
+            registration_ids = message['registration_ids']
+        else:
+            registration_ids = [message['to']]
+        server.record(registration_ids, message)
+
+        if server.latency:
+            with server.in_flight():
+                time.sleep(server.latency)
+
+        if self.headers.get('Authorization') != 'key={}'.format(
+                server.api_key):
+            return self.respond(401, {})
+        if any(registration_id.startswith('BAD_REQUEST')
+               for registration_id in registration_ids):
+            return self.respond(400, {})
+        if any(registration_id.startswith('SERVER_DOWN')
+               for registration_id in registration_ids):
+            return self.respond(503, {}, {'Retry-After': '120'})
+
+        results = [server.result_for(registration_id)
+                   for registration_id in registration_ids]
+        self.respond(200, {
+            'success': len([r for r in results if 'error' not in r]),
+            'failure': len([r for r in results if 'error' in r]),
+            'results': results
+        })
+
+    def respond(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServer(object):
+    """Base for local provider endpoints running in a background thread.
+
+    ``latency`` delays every response by that many seconds and
+    ``error_rate`` makes that fraction of the devices fail with a
+    retryable error. Requests are kept in ``requests`` unless ``record``
+    is False, which long benchmark runs should use. ``max_in_flight`` is
+    the largest number of requests waiting on ``latency`` at once.
+    """
+    server_class = None
+    handler_class = None
+
+    def __init__(self, latency=0, error_rate=0, record=True):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.record_requests = record
+        self.requests = []
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._random = random.Random(0)
+        self._lock = threading.Lock()
+        self._server = self.server_class(
+            ('127.0.0.1', 0),
+            self.handler_class
+        )
+        self._server.fake_server = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def record(self, *request):
+        if self.record_requests:
+            with self._lock:
+                self.requests.append(request)
+
+    @contextmanager
+    def in_flight(self):
+        with self._lock:
+            self._in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def fail_randomly(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class FakeGCMServer(FakeServer):
+    """Local GCM endpoint answering based on the registration id.
+
+    Ids starting with ``INVALID`` are reported as not registered, ids
+    starting with ``CANONICAL`` get a new canonical id and ids starting with
+    ``UNAVAILABLE`` fail with a retryable error. Requests with an id
+    starting with ``BAD_REQUEST`` are rejected as a whole with a 400 and
+    requests with an id starting with ``SERVER_DOWN`` with a 503.
+    """
+    server_class = ThreadingHTTPServer
+    handler_class = FakeGCMHandler
+
+    def __init__(self, api_key='SOME_TEST_KEY', **kwargs):
+        self.api_key = api_key
+        super(FakeGCMServer, self).__init__(**kwargs)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/gcm/send'.format(self.address[1])
+
+    def result_for(self, registration_id):
+        if registration_id.startswith('INVALID'):
+            return {'error': 'NotRegistered'}
+        if registration_id.startswith('UNAVAILABLE') or self.fail_randomly():
+            return {'error': 'Unavailable'}
+        if registration_id.startswith('CANONICAL'):
+            return {
+                'message_id': '1',
+                'registration_id': 'NEW_{}'.format(registration_id)
+            }
+        return {'message_id': '1'}
+
+
+# APNS binary protocol error response command and codes
+APNS_ERROR_RESPONSE = 8
+APNS_INVALID_TOKEN = 8
+APNS_SHUTDOWN = 10
+
+
+class FakeAPNSHandler(BaseRequestHandler):
+    def handle(self):
+        server = self.server.fake_server
+        buffer = b''
+
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            buffer += data
+
+            # Every frame is a command byte and the frame length
+            # followed by the frame items
+            while len(buffer) >= 5:
+                frame_len = struct.unpack('>I', buffer[1:5])[0]
+                if len(buffer) < 5 + frame_len:
+                    break
+                frame, buffer = buffer[5:5 + frame_len], buffer[5 + frame_len:]
+
+                token, identifier = self.parse_frame(frame)
+                server.record(token, identifier)
+
+                error = server.error_for(token)
+                if error:
+                    if server.latency:
+                        time.sleep(server.latency)
+                    # APNS answers the first failed notification and
+                    # ignores everything sent after it
+                    self.request.sendall(struct.pack(
+                        '>BBI', APNS_ERROR_RESPONSE, error, identifier
+                    ))
+                    return self.drain()
+
+    def drain(self):
+        # Wait for the client to close the connection so that it can
+        # read the error response
+        while self.request.recv(65536):
+            pass
+
+    def parse_frame(self, frame):
+        items = {}
+        pos = 0
+        while pos < len(frame):
+            item_id, item_len = struct.unpack('>BH', frame[pos:pos + 3])
+            items[item_id] = frame[pos + 3:pos + 3 + item_len]
+            pos += 3 + item_len
+
+        token = hexlify(items[1]).decode('ascii')
+        identifier = struct.unpack('>I', items[3])[0]
+        return token, identifier
+
+
+class FakeAPNSServer(FakeServer):
+    """Local endpoint speaking the APNS binary protocol without TLS.
+
+    Tokens starting with ``ff`` are rejected as invalid and tokens
+    starting with ``ee`` fail with a retryable shutdown error. Clients
+    connect to it through ``FakeAPNSConnection``.
+    """
+    server_class = ThreadingTCPServer
+    handler_class = FakeAPNSHandler
+
+    def error_for(self, token):
+        if token.startswith('ff'):
+            return APNS_INVALID_TOKEN
+        if token.startswith('ee') or self.fail_randomly():
+            return APNS_SHUTDOWN
+        return None
+
+    def create_connection(self):
+        return FakeAPNSConnection(self.address[0], self.address[1])
+
+
+class PlainSocket(socket.socket):
+    # APNSConnection reads with the SSL socket API
+    def read(self, size):
+        return self.recv(size)
+
+
+class FakeAPNSConnection(APNSConnection):
+    def __init__(self, host, port):
+        super(FakeAPNSConnection, self).__init__(host, port, None)
+
+    def connect(self):
+        if self.sock:
+            return
+
+        self.sock = PlainSocket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect((self.host, self.port))
@@ -1,8 +1,14 @@
 from django.contrib.auth import get_user_model
 import mock
 from django.test import TestCase
-from pushy.utils import send_push_notification
-from pushy.models import PushNotification, Device
+from django.test.utils import override_settings
+from pushy.tasks import get_notification_message
+from pushy.utils import (
+    send_push_notification,
+    send_push_notification_bulk,
+    replay_dead_letters
+)
+from pushy.models import DeadLetter, PushNotification, Device
 
 
 class AddTaskTestCase(TestCase):
@@ -24,14 +30,31 @@ class AddTaskTestCase(TestCase):
             )
 
             self.assertEquals(notification.payload, self.payload)
+            self.assertEqual(
+                notification.sent,
+                PushNotification.PUSH_IN_PROGRESS
+            )
+
+    def test_add_task_publish_failure(self):
+        with mock.patch('pushy.tasks.create_push_notification_groups.delay',
+                        side_effect=IOError):
+            self.assertRaises(
+                IOError,
+                send_push_notification,
+                'some test push notification', self.payload
+            )
+
+        # Left for check_pending_push_notifications to pick up
+        notification = PushNotification.objects.latest('id')
+        self.assertEqual(notification.sent, PushNotification.PUSH_NOT_SENT)
+        self.assertIsNone(notification.date_started)
 
     def test_add_task_filter_device(self):
         device = Device.objects.create(key='TEST_DEVICE_KEY',
                                        type=Device.DEVICE_TYPE_IOS)
 
         mock_task = mock.Mock()
-        with mock.patch('pushy.tasks.send_single_push_notification.apply_async',
-                        new=mock_task) as mocked_task:
+        with mock.patch('celery.group', new=mock_task) as mocked_task:
             send_push_notification(
                 'some other test push notification',
                 self.payload,
@@ -40,10 +63,47 @@ class AddTaskTestCase(TestCase):
 
             notification = PushNotification.objects.latest('id')
 
-            mocked_task.assert_called_with(kwargs={
-                'device': device.id,
-                'notification': notification.to_dict()
-            })
+            signatures = list(mocked_task.call_args[0][0])
+            self.assertEqual(len(signatures), 1)
+            self.assertEqual(signatures[0].args, (
+                get_notification_message(notification.to_dict()),
+                [device.id]
+            ))
+            self.assertEqual(notification.remaining_groups, 1)
+
+    @override_settings(PUSHY_DEVICE_KEY_LIMIT=2)
+    def test_send_push_notification_bulk(self):
+        devices = [
+            Device.objects.create(key='TEST_DEVICE_KEY_{}'.format(i),
+                                  type=Device.DEVICE_TYPE_ANDROID)
+            for i in range(3)
+        ]
+
+        mock_task = mock.Mock()
+        with mock.patch('celery.group', new=mock_task) as mocked_task:
+            notification = send_push_notification_bulk(
+                'test', self.payload,
+                [devices[2], devices[0].id, devices[1], devices[0]]
+            )
+
+            mocked_task.return_value.apply_async.assert_called_once_with()
+            signatures = mocked_task.call_args[0][0]
+            self.assertEqual(
+                [signature.args[1] for signature in signatures],
+                [[devices[0].id, devices[1].id], [devices[2].id]]
+            )
+
+        notification.refresh_from_db()
+        self.assertEqual(notification.sent, PushNotification.PUSH_IN_PROGRESS)
+        self.assertEqual(notification.remaining_groups, 2)
+        self.assertEqual(notification.audience_size, 3)
+
+    def test_send_push_notification_bulk_no_devices(self):
+        with mock.patch('celery.group'):
+            notification = send_push_notification_bulk('test', {}, [])
+
+        notification.refresh_from_db()
+        self.assertEqual(notification.sent, PushNotification.PUSH_SENT)
 
     def test_add_task_filter_on_user(self):
         user = get_user_model().objects.create_user(
@@ -105,6 +165,36 @@ class AddTaskTestCase(TestCase):
             self.assertEqual(notification.filter_user, user.id)
             self.assertEqual(notification.filter_type, Device.DEVICE_TYPE_IOS)
 
+    def test_add_task_filter_on_users_and_device_types(self):
+        with mock.patch('pushy.tasks.create_push_notification_groups.delay') \
+                as mocked_task:
+            notification = send_push_notification(
+                'test', self.payload,
+                filter_users=[4, 1, 2, 3],
+                filter_types=[Device.DEVICE_TYPE_IOS,
+                              Device.DEVICE_TYPE_ANDROID]
+            )
+
+            mocked_task.assert_called_with(notification=notification.to_dict())
+            notification = PushNotification.objects.get(pk=notification.pk)
+            self.assertTrue(notification.filter_targets)
+            self.assertEqual(notification.filter_types, '1,2')
+            self.assertEqual(
+                sorted(notification.targets.values_list('user_id',
+                                                        flat=True)),
+                [1, 2, 3, 4]
+            )
+
+    def test_add_task_filter_on_users_without_storage(self):
+        with mock.patch('pushy.tasks.create_push_notification_groups.delay'):
+            self.assertRaises(
+                ValueError,
+                send_push_notification,
+                'test', {},
+                filter_users=[1],
+                store=False
+            )
+
     def test_add_task_without_storage(self):
         with mock.patch('pushy.tasks.create_push_notification_groups.delay'):
             notification = send_push_notification(
@@ -114,3 +204,54 @@ class AddTaskTestCase(TestCase):
             )
 
             self.assertIsNone(notification.id)
+
+    def test_replay_dead_letters(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload
+        )
+        devices = [
+            Device.objects.create(key='TEST_DEVICE_KEY_{}'.format(i),
+                                  type=Device.DEVICE_TYPE_ANDROID)
+            for i in range(3)
+        ]
+        for device in devices[:2]:
+            DeadLetter.objects.create(
+                notification=notification,
+                device=device,
+                error='PushServerException'
+            )
+        # Dead letters of stored notifications used to keep the payload
+        DeadLetter.objects.create(
+            notification=notification,
+            device=devices[2],
+            payload=self.payload,
+            error='PushServerException'
+        )
+        DeadLetter.objects.create(
+            device=devices[0],
+            payload={'other': 'payload'},
+            error='PushServerException'
+        )
+
+        mock_task = mock.Mock()
+        with mock.patch('pushy.tasks.send_push_notification_devices.delay',
+                        new=mock_task):
+            self.assertEqual(replay_dead_letters(), 4)
+
+        # One task per notification and payload, tasks load the payload
+        # of stored notifications
+        self.assertEqual(mock_task.call_count, 3)
+        mock_task.assert_any_call(
+            notification={'id': notification.id},
+            device_ids=[devices[0].id, devices[1].id]
+        )
+        mock_task.assert_any_call(
+            notification={'id': notification.id, 'payload': self.payload},
+            device_ids=[devices[2].id]
+        )
+        mock_task.assert_any_call(
+            notification={'id': None, 'payload': {'other': 'payload'}},
+            device_ids=[devices[0].id]
+        )
+        self.assertFalse(DeadLetter.objects.exists())
@@ -0,0 +1,34 @@
+from django.test import TestCase
+
+from pushy.admin import PushNotificationForm
+from pushy.models import Device, PushNotification
+
+
+class PushNotificationFormTestCase(TestCase):
+    def get_form(self, filter_types, instance=None):
+        return PushNotificationForm(data={
+            'title': 'test',
+            'body': '{}',
+            'active': PushNotification.PUSH_ACTIVE,
+            'sent': PushNotification.PUSH_NOT_SENT,
+            'filter_type': 0,
+            'filter_user': 0,
+            'filter_types': filter_types
+        }, instance=instance)
+
+    def test_filter_types(self):
+        form = self.get_form([str(Device.DEVICE_TYPE_IOS),
+                              str(Device.DEVICE_TYPE_ANDROID)])
+
+        self.assertTrue(form.is_valid(), form.errors)
+        notification = form.save()
+        self.assertEqual(notification.filter_types, '1,2')
+
+        form = PushNotificationForm(instance=notification)
+        self.assertEqual(form.initial['filter_types'], [1, 2])
+
+    def test_invalid_filter_types(self):
+        form = self.get_form(['ios'])
+
+        self.assertFalse(form.is_valid())
+        self.assertIn('filter_types', form.errors)
@@ -0,0 +1,162 @@
+import sys
+import unittest
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from pushy import dispatchers
+from pushy.exceptions import (
+    PushAuthException,
+    PushInvalidDataException,
+    PushInvalidTokenException,
+    PushServerException
+)
+from pushy.models import Device, PushNotification
+from pushy.tasks import send_push_notification_chunk
+
+from .fake_servers import FakeGCMServer
+
+try:
+    import aiohttp  # noqa
+    HAS_AIOHTTP = sys.version_info >= (3, 5)
+except ImportError:
+    HAS_AIOHTTP = False
+
+
+@unittest.skipUnless(HAS_AIOHTTP, 'asyncio engine requires aiohttp')
+class AsyncGCMDispatcherTestCase(TestCase):
+    def setUp(self):
+        from pushy.contrib.aio.dispatchers import AsyncGCMDispatcher
+
+        self.server = FakeGCMServer().start()
+        self.settings_override = override_settings(
+            PUSHY_GCM_URL=self.server.url,
+            PUSHY_ASYNC_BATCH_SIZE=2,
+            PUSHY_ASYNC_CONCURRENCY=2
+        )
+        self.settings_override.enable()
+        self.dispatcher = AsyncGCMDispatcher()
+
+    def tearDown(self):
+        self.dispatcher.close()
+        self.settings_override.disable()
+        self.server.stop()
+
+    def test_send_batch(self):
+        device_keys = [
+            'KEY1', 'INVALID1', 'CANONICAL1', 'UNAVAILABLE1', 'KEY2'
+        ]
+
+        canonical_ids, errors = self.dispatcher.send_batch(
+            device_keys,
+            {'key': 'value'}
+        )
+
+        # Keys are split into concurrent requests of at most 2 keys
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(
+            sorted(key for ids, _ in self.server.requests for key in ids),
+            sorted(device_keys)
+        )
+        self.assertEqual(
+            self.server.requests[0][1]['data'],
+            {'key': 'value'}
+        )
+
+        self.assertEqual(canonical_ids, {'CANONICAL1': 'NEW_CANONICAL1'})
+        self.assertEqual(set(errors.keys()), {'INVALID1', 'UNAVAILABLE1'})
+        self.assertIsInstance(errors['INVALID1'], PushInvalidTokenException)
+        self.assertIsInstance(errors['UNAVAILABLE1'], PushServerException)
+
+    def test_send_batch_default_concurrency(self):
+        # With the default settings a chunk of 1000 devices is sent with
+        # several requests in flight
+        self.settings_override.disable()
+        try:
+            with FakeGCMServer(latency=0.2) as server, \
+                    override_settings(PUSHY_GCM_URL=server.url):
+                dispatcher = type(self.dispatcher)()
+                try:
+                    canonical_ids, errors = dispatcher.send_batch(
+                        ['KEY{}'.format(i) for i in range(1000)],
+                        {}
+                    )
+                finally:
+                    dispatcher.close()
+        finally:
+            self.settings_override.enable()
+
+        self.assertEqual(errors, {})
+        self.assertEqual(len(server.requests), 10)
+        self.assertEqual(server.max_in_flight, 10)
+
+    def test_send_batch_bad_request(self):
+        canonical_ids, errors = self.dispatcher.send_batch(
+            ['INVALID1', 'CANONICAL1', 'BAD_REQUEST1', 'KEY1', 'KEY2'],
+            {}
+        )
+
+        # Only the keys of the rejected request fail, the results of the
+        # other requests are kept
+        self.assertEqual(canonical_ids, {'CANONICAL1': 'NEW_CANONICAL1'})
+        self.assertEqual(set(errors.keys()),
+                         {'INVALID1', 'BAD_REQUEST1', 'KEY1'})
+        self.assertIsInstance(errors['INVALID1'], PushInvalidTokenException)
+        self.assertIsInstance(errors['BAD_REQUEST1'], PushInvalidDataException)
+        self.assertIsInstance(errors['KEY1'], PushInvalidDataException)
+
+    def test_send_batch_reuses_session(self):
+        self.dispatcher.send_batch(['KEY1'], {})
+        session = self.dispatcher._session
+        self.dispatcher.send_batch(['KEY2'], {})
+        self.assertIs(self.dispatcher._session, session)
+
+    def test_send_batch_wrong_api_key(self):
+        dispatcher = type(self.dispatcher)('WRONG_KEY')
+        try:
+            self.assertRaises(
+                PushAuthException,
+                dispatcher.send_batch,
+                ['KEY1'],
+                {}
+            )
+        finally:
+            dispatcher.close()
+
+    def test_send_batch_server_down(self):
+        with override_settings(PUSHY_GCM_URL='http://127.0.0.1:1/gcm/send'):
+            canonical_ids, errors = self.dispatcher.send_batch(
+                ['KEY1', 'KEY2'],
+                {}
+            )
+
+        self.assertEqual(canonical_ids, {})
+        self.assertIsInstance(errors['KEY1'], PushServerException)
+        self.assertIsInstance(errors['KEY2'], PushServerException)
+
+    def test_send_push_notification_group(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload={'key': 'value'},
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_NOT_SENT
+        )
+        for key in ['KEY1', 'INVALID1', 'CANONICAL1']:
+            Device.objects.create(key=key, type=Device.DEVICE_TYPE_ANDROID)
+
+        dispatchers.dispatchers_cache = {}
+        with override_settings(PUSHY_DISPATCH_ENGINE='asyncio'):
+            dispatcher = dispatchers.get_dispatcher(
+                Device.DEVICE_TYPE_ANDROID
+            )
+            self.assertIsInstance(dispatcher, type(self.dispatcher))
+            try:
+                send_push_notification_chunk(notification.to_dict())
+            finally:
+                dispatcher.close()
+                dispatchers.dispatchers_cache = {}
+
+        self.assertEqual(
+            sorted(Device.objects.values_list('key', flat=True)),
+            ['KEY1', 'NEW_CANONICAL1']
+        )
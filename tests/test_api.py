@@ -1,7 +1,11 @@
+from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
 from rest_framework import status
 from rest_framework.test import APITestCase
 
+from pushy.models import Device
+
 
 class APITests(APITestCase):
     def setUp(self):
@@ -41,9 +45,21 @@ class APITests(APITestCase):
 
         response = self.create_device(data)
 
-        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
-        self.assertEqual(response.data['non_field_errors'][0],
-                         'The fields key, type must make a unique set.')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Device.objects.count(), 1)
+
+    def test_create_device_reassigns_user(self):
+        data = {'key': 'KEY1', 'type': 'android'}
+        self.create_device(data)
+
+        user = get_user_model().objects.create_user(
+            'test_user', self.email, self.password
+        )
+        self.client.force_authenticate(user)
+        response = self.create_device(data)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Device.objects.get().user_id, user.id)
 
     def test_destroy_device(self):
         data = {'key': 'KEY1', 'type': 'ios'}
@@ -55,6 +71,64 @@ class APITests(APITestCase):
         response = self.destroy_device({'key': 'does not exist'})
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_batch_create_devices(self):
+        Device.objects.create(key='KEY1', type=Device.DEVICE_TYPE_ANDROID)
+        data = [
+            {'key': 'KEY1', 'type': 'android'},
+            {'key': 'KEY2', 'type': 'ios'},
+            {'key': 'KEY3', 'type': 'unknown'},
+            {'key': 'KEY2', 'type': 'ios'}
+        ]
+
+        response = self.client.post(reverse('pushy-devices-batch'), data,
+                                    format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [result['status'] for result in response.data],
+            [201, 201, 400, 201]
+        )
+        self.assertEqual(response.data[2]['errors'],
+                         {'type': ['"unknown" is not a valid choice.']})
+        self.assertEqual(
+            sorted(Device.objects.values_list('key', 'type')),
+            [('KEY1', Device.DEVICE_TYPE_ANDROID),
+             ('KEY2', Device.DEVICE_TYPE_IOS)]
+        )
+
+    def test_batch_destroy_devices(self):
+        Device.objects.create(key='KEY1', type=Device.DEVICE_TYPE_ANDROID)
+        Device.objects.create(key='KEY2', type=Device.DEVICE_TYPE_IOS)
+        data = [{'key': 'KEY1'}, {'key': 'KEY3'}, {}]
+
+        response = self.client.delete(reverse('pushy-devices-batch'), data,
+                                      format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [result['status'] for result in response.data],
+            [200, 404, 400]
+        )
+        self.assertEqual(list(Device.objects.values_list('key', flat=True)),
+                         ['KEY2'])
+
+    @override_settings(PUSHY_DEVICE_BATCH_MAX_SIZE=1)
+    def test_batch_too_large(self):
+        data = [{'key': 'KEY1', 'type': 'ios'}, {'key': 'KEY2', 'type': 'ios'}]
+
+        response = self.client.post(reverse('pushy-devices-batch'), data,
+                                    format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Device.objects.exists())
+
+    def test_batch_not_a_list(self):
+        response = self.client.post(reverse('pushy-devices-batch'),
+                                    {'key': 'KEY1', 'type': 'ios'},
+                                    format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def create_device(self, data):
         url = reverse('pushy-devices')
 
@@ -1,10 +1,16 @@
+import json
+import threading
+
 import mock
 
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from pushjack.apns import APNSSandboxClient
 from pushjack.exceptions import (
     GCMMissingRegistrationError,
+    GCMUnregisteredDeviceError,
     GCMInvalidPackageNameError,
     GCMTimeoutError,
     GCMAuthError,
@@ -24,10 +30,13 @@ from pushy.exceptions import (
 from pushy.models import Device
 from pushy import dispatchers
 
+from .fake_servers import FakeAPNSServer, FakeGCMServer
 from .data import (
     valid_response,
     valid_with_canonical_id_response,
-    invalid_with_exception
+    invalid_with_exception,
+    batch_response,
+    apns_batch_response
 )
 
 
@@ -55,6 +64,62 @@ class DispatchersTestCase(TestCase):
             {1: dispatcher1, 2: dispatcher2}
         )
 
+    def test_cache_reset_after_fork(self):
+        dispatcher = dispatchers.get_dispatcher(Device.DEVICE_TYPE_ANDROID)
+        self.assertIs(
+            dispatchers.get_dispatcher(Device.DEVICE_TYPE_ANDROID),
+            dispatcher
+        )
+
+        # A forked worker process must not reuse the parent's connections
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(
+                dispatchers.get_dispatcher(Device.DEVICE_TYPE_ANDROID),
+                dispatcher
+            )
+
+    def test_send_batch_falls_back_to_single_sends(self):
+        dispatcher = dispatchers.Dispatcher()
+        send = mock.Mock()
+        send.side_effect = ['NEW_KEY1', PushInvalidTokenException()]
+        with mock.patch.object(dispatcher, 'send', new=send):
+            canonical_ids, errors = dispatcher.send_batch(
+                ['KEY1', 'KEY2'],
+                {}
+            )
+
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(canonical_ids, {'KEY1': 'NEW_KEY1'})
+        self.assertEqual(list(errors.keys()), ['KEY2'])
+        self.assertIsInstance(errors['KEY2'], PushInvalidTokenException)
+
+    @mock.patch('django.conf.settings.PUSHY_DISPATCH_ENGINE', new='unknown',
+                create=True)
+    def test_unknown_dispatch_engine(self):
+        dispatchers.dispatchers_cache = {}
+        self.assertRaises(
+            ImproperlyConfigured,
+            dispatchers.get_dispatcher,
+            Device.DEVICE_TYPE_ANDROID
+        )
+
+    def test_thread_dispatchers(self):
+        dispatcher = dispatchers.get_thread_dispatcher(Device.DEVICE_TYPE_IOS)
+        self.assertIs(
+            dispatchers.get_thread_dispatcher(Device.DEVICE_TYPE_IOS),
+            dispatcher
+        )
+
+        other_dispatchers = []
+        thread = threading.Thread(target=lambda: other_dispatchers.append(
+            dispatchers.get_thread_dispatcher(Device.DEVICE_TYPE_IOS)
+        ))
+        thread.start()
+        thread.join()
+
+        self.assertIsInstance(other_dispatchers[0], dispatchers.APNSDispatcher)
+        self.assertIsNot(other_dispatchers[0], dispatcher)
+
     def test_dispatcher_types(self):
         # Double check the factory method returning the correct types
         self.assertIsInstance(
@@ -75,6 +140,47 @@ class GCMDispatcherTestCase(TestCase):
         dispatcher = dispatchers.GCMDispatcher(123)
         self.assertEquals(123, dispatcher._api_key)
 
+    def test_client_is_reused(self):
+        dispatcher = dispatchers.GCMDispatcher()
+        with mock.patch('pushjack.GCMClient.send') as request_mock:
+            request_mock.return_value = valid_response()
+            dispatcher.send(self.device_key, self.data)
+            client = dispatcher.client
+            dispatcher.send(self.device_key, self.data)
+            self.assertIs(dispatcher.client, client)
+
+    @mock.patch('django.conf.settings.PUSHY_GCM_POOL_SIZE', new=25,
+                create=True)
+    def test_client_connection_pool(self):
+        dispatcher = dispatchers.GCMDispatcher()
+        adapter = dispatcher.client.conn.session.get_adapter(
+            'https://android.googleapis.com/gcm/send'
+        )
+        self.assertEqual(adapter._pool_maxsize, 25)
+
+    def test_prepare(self):
+        dispatcher = dispatchers.GCMDispatcher()
+        prepared = dispatcher.prepare(self.data)
+
+        self.assertIs(prepared.data, self.data)
+        self.assertEqual(
+            json.loads(prepared.body.decode('utf-8')),
+            {'data': self.data, 'priority': 'high'}
+        )
+
+        with mock.patch('pushjack.GCMClient.send') as request_mock:
+            request_mock.return_value = batch_response()
+            dispatcher.send_batch([self.device_key], prepared)
+            request_mock.assert_called_once_with([self.device_key], self.data)
+
+    def test_prepare_payload_too_big(self):
+        dispatcher = dispatchers.GCMDispatcher()
+        self.assertRaises(
+            PushInvalidDataException,
+            dispatcher.prepare,
+            {'body': 'x' * dispatchers.GCM_MAX_DATA_SIZE}
+        )
+
     def test_send_with_no_api_key(self):
         # Check that we throw the proper exception
         # in case no API Key is specified
@@ -163,6 +269,98 @@ class GCMDispatcherTestCase(TestCase):
                 self.data
             )
 
+    def test_send_batch(self):
+        dispatcher = dispatchers.GCMDispatcher()
+        device_keys = ['KEY1', 'KEY2', 'KEY3', 'KEY4']
+        response_mock = mock.Mock()
+        response_mock.return_value = batch_response(
+            canonical_ids={'KEY1': 'NEW_KEY1'},
+            errors=[
+                GCMUnregisteredDeviceError('KEY2'),
+                GCMTimeoutError('KEY3')
+            ]
+        )
+        with mock.patch('pushjack.GCMClient.send', new=response_mock):
+            canonical_ids, errors = dispatcher.send_batch(
+                device_keys,
+                self.data
+            )
+
+        # The whole batch goes out in a single call
+        response_mock.assert_called_once_with(device_keys, self.data)
+        self.assertEqual(canonical_ids, {'KEY1': 'NEW_KEY1'})
+        self.assertEqual(set(errors.keys()), {'KEY2', 'KEY3'})
+        self.assertIsInstance(errors['KEY2'], PushInvalidTokenException)
+        self.assertIsInstance(errors['KEY3'], PushServerException)
+
+    def test_send_batch_unknown_failure(self):
+        dispatcher = dispatchers.GCMDispatcher()
+        response = batch_response()
+        response.failures.append('KEY1')
+        with mock.patch('pushjack.GCMClient.send', return_value=response):
+            canonical_ids, errors = dispatcher.send_batch(['KEY1'], self.data)
+
+        self.assertEqual(canonical_ids, {})
+        self.assertIsInstance(errors['KEY1'], PushServerException)
+
+    def test_send_batch_request_unavailable(self):
+        dispatcher = dispatchers.GCMDispatcher()
+        response = batch_response()
+        response.responses.append(
+            mock.Mock(status_code=503, headers={'Retry-After': '120'})
+        )
+        response.messages.append({'registration_ids': ['KEY1', 'KEY2']})
+        with mock.patch('pushjack.GCMClient.send', return_value=response):
+            canonical_ids, errors = dispatcher.send_batch(
+                ['KEY1', 'KEY2'],
+                self.data
+            )
+
+        self.assertEqual(set(errors.keys()), {'KEY1', 'KEY2'})
+        self.assertIsInstance(errors['KEY1'], PushServerException)
+        self.assertEqual(errors['KEY1'].retry_after, 120)
+
+    def test_send_batch_request_unauthorized(self):
+        dispatcher = dispatchers.GCMDispatcher()
+        response = batch_response()
+        response.responses.append(mock.Mock(status_code=401, headers={}))
+        response.messages.append({'registration_ids': ['KEY1']})
+        with mock.patch('pushjack.GCMClient.send', return_value=response):
+            self.assertRaises(
+                PushAuthException,
+                dispatcher.send_batch,
+                ['KEY1'],
+                self.data
+            )
+
+    def test_parse_retry_after(self):
+        self.assertIsNone(dispatchers.parse_retry_after(None))
+        self.assertIsNone(dispatchers.parse_retry_after('soon'))
+        self.assertEqual(dispatchers.parse_retry_after('30'), 30)
+        self.assertEqual(
+            dispatchers.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'),
+            0
+        )
+        with mock.patch('pushy.dispatchers.time.time',
+                        return_value=1445412420):
+            self.assertEqual(
+                dispatchers.parse_retry_after(
+                    'Wed, 21 Oct 2015 07:28:00 GMT'
+                ),
+                60
+            )
+
+    def test_send_batch_auth_error(self):
+        dispatcher = dispatchers.GCMDispatcher()
+        with mock.patch('pushjack.GCMClient.send',
+                        side_effect=GCMAuthError('')):
+            self.assertRaises(
+                PushAuthException,
+                dispatcher.send_batch,
+                ['KEY1'],
+                self.data
+            )
+
 
 class ApnsDispatcherTests(TestCase):
     device_key = 'TEST_DEVICE_KEY'
@@ -250,3 +448,149 @@ class ApnsDispatcherTests(TestCase):
                 self.dispatcher.send(self.device_key, self.data),
                 None
             )
+
+    def test_send_batch(self):
+        tokens = ['{:064x}'.format(i) for i in range(4)]
+        apns = mock.Mock()
+        apns.return_value = apns_batch_response({
+            tokens[1]: APNSMissingTokenError(1),
+            tokens[2]: APNSShutdownError(2)
+        })
+        with mock.patch('pushjack.APNSClient.send', new=apns):
+            canonical_ids, errors = self.dispatcher.send_batch(
+                tokens,
+                {'title': 'Title', 'message': 'Message', 'key': 'value'}
+            )
+
+        # A single call to the client with the alert prepared once
+        apns.assert_called_once_with(
+            tokens,
+            title='Title',
+            message='Message',
+            sound=None,
+            badge=None,
+            category=None,
+            content_available=True,
+            extra={'key': 'value'}
+        )
+        self.assertEqual(canonical_ids, {})
+        self.assertEqual(set(errors.keys()), {tokens[1], tokens[2]})
+        self.assertIsInstance(errors[tokens[1]], PushInvalidTokenException)
+        self.assertIsInstance(errors[tokens[2]], PushServerException)
+
+    def test_send_batch_malformed_tokens(self):
+        valid_token = '0' * 64
+        apns = mock.Mock()
+        apns.return_value = apns_batch_response()
+        with mock.patch('pushjack.APNSClient.send', new=apns):
+            canonical_ids, errors = self.dispatcher.send_batch(
+                [valid_token, 'NOT_A_TOKEN'],
+                self.data
+            )
+
+        # Malformed tokens don't fail the rest of the batch
+        self.assertEqual(apns.call_args[0][0], [valid_token])
+        self.assertEqual(list(errors.keys()), ['NOT_A_TOKEN'])
+        self.assertIsInstance(errors['NOT_A_TOKEN'], PushInvalidTokenException)
+
+    def test_send_batch_payload_not_altered(self):
+        payload = {'title': 'Title', 'message': 'Message'}
+        apns = mock.Mock()
+        apns.return_value = apns_batch_response()
+        with mock.patch('pushjack.APNSClient.send', new=apns):
+            self.dispatcher.send_batch(['0' * 64], payload)
+
+        self.assertEqual(payload, {'title': 'Title', 'message': 'Message'})
+
+    def test_send_batch_exception(self):
+        with mock.patch('pushjack.APNSClient.send',
+                        side_effect=APNSAuthError('')):
+            self.assertRaises(
+                PushAuthException,
+                self.dispatcher.send_batch,
+                ['0' * 64],
+                self.data
+            )
+
+    def test_prepare(self):
+        payload = {'title': 'Title', 'badge': 1, 'key': 'value'}
+        prepared = self.dispatcher.prepare(payload)
+
+        self.assertEqual(prepared.data['title'], 'Title')
+        self.assertEqual(prepared.data['badge'], 1)
+        self.assertEqual(prepared.data['extra'], {'key': 'value'})
+        self.assertEqual(
+            json.loads(prepared.body.decode('utf-8')),
+            {
+                'aps': {'alert': {'title': 'Title'}, 'badge': 1,
+                        'content-available': 1},
+                'key': 'value'
+            }
+        )
+        self.assertEqual(payload, {'title': 'Title', 'badge': 1,
+                                   'key': 'value'})
+
+    def test_prepare_payload_too_big(self):
+        self.assertRaises(
+            PushInvalidDataException,
+            self.dispatcher.prepare,
+            {'message': 'x' * 2048}
+        )
+
+
+class FakeGCMServerTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeGCMServer().start()
+        self.addCleanup(self.server.stop)
+        settings_override = override_settings(PUSHY_GCM_URL=self.server.url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_send_batch_single_key_unavailable(self):
+        dispatcher = dispatchers.GCMDispatcher()
+
+        canonical_ids, errors = dispatcher.send_batch(['SERVER_DOWN1'], {})
+
+        self.assertEqual(canonical_ids, {})
+        self.assertEqual(list(errors.keys()), ['SERVER_DOWN1'])
+        self.assertIsInstance(errors['SERVER_DOWN1'], PushServerException)
+        self.assertEqual(errors['SERVER_DOWN1'].retry_after, 120)
+
+    def test_send_batch_single_key_bad_request(self):
+        dispatcher = dispatchers.GCMDispatcher()
+
+        canonical_ids, errors = dispatcher.send_batch(['BAD_REQUEST1'], {})
+
+        self.assertIsInstance(errors['BAD_REQUEST1'], PushInvalidDataException)
+
+
+class FakeAPNSServerTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeAPNSServer().start()
+        self.addCleanup(self.server.stop)
+        patcher = mock.patch(
+            'pushjack.APNSClient.create_connection',
+            new=lambda client: self.server.create_connection()
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(PUSHY_APNS_ERROR_TIMEOUT=0.1)
+    def test_send_batch(self):
+        dispatcher = dispatchers.APNSDispatcher()
+        tokens = ['aa' * 32, 'ff' * 32, 'bb' * 32, 'ee' * 32, 'cc' * 32]
+
+        canonical_ids, errors = dispatcher.send_batch(
+            tokens,
+            {'title': 'Title', 'message': 'Message'}
+        )
+
+        # Sending resumes after every failed token
+        self.assertEqual(
+            [token for token, _ in self.server.requests],
+            tokens
+        )
+        self.assertEqual(canonical_ids, {})
+        self.assertEqual(set(errors.keys()), {'ff' * 32, 'ee' * 32})
+        self.assertIsInstance(errors['ff' * 32], PushInvalidTokenException)
+        self.assertIsInstance(errors['ee' * 32], PushServerException)
@@ -0,0 +1,98 @@
+import socket
+
+import mock
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from pushy.exceptions import PushInvalidTokenException
+from pushy.instrumentation import (
+    InstrumentationBackend,
+    StatsdBackend,
+    get_instrumentation
+)
+from pushy.models import Device, PushNotification
+from pushy.tasks import send_push_notification_chunk
+
+
+class RecordingBackend(InstrumentationBackend):
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def timing(self, name, seconds):
+        self.timings.setdefault(name, []).append(seconds)
+
+
+class InstrumentationTestCase(TestCase):
+    def test_default_backend(self):
+        backend = get_instrumentation()
+
+        self.assertEqual(type(backend), InstrumentationBackend)
+        self.assertIs(get_instrumentation(), backend)
+        with backend.timer('noop'):
+            backend.incr('noop')
+
+    @override_settings(
+        PUSHY_INSTRUMENTATION_BACKEND='pushy.instrumentation.StatsdBackend',
+        PUSHY_INSTRUMENTATION_OPTIONS={'port': 9125, 'prefix': 'app'}
+    )
+    def test_configured_backend(self):
+        backend = get_instrumentation()
+
+        self.assertIsInstance(backend, StatsdBackend)
+        self.assertEqual(backend.address, ('localhost', 9125))
+        self.assertEqual(backend.prefix, 'app')
+
+    def test_statsd_backend(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(1)
+
+        backend = StatsdBackend('127.0.0.1', server.getsockname()[1])
+        backend.incr('gcm.sent', 5)
+        backend.timing('gcm.latency', 0.25)
+
+        self.assertEqual(server.recv(512), b'pushy.gcm.sent:5|c')
+        self.assertEqual(server.recv(512), b'pushy.gcm.latency:250|ms')
+
+    def test_send_push_notification_group(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload={'key': 'value'},
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_IN_PROGRESS
+        )
+        for i in range(3):
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_ANDROID_{}'.format(i),
+                type=Device.DEVICE_TYPE_ANDROID
+            )
+
+        backend = RecordingBackend()
+        gcm = mock.Mock(return_value=(
+            {},
+            {'TEST_DEVICE_KEY_ANDROID_1': PushInvalidTokenException()}
+        ))
+        with mock.patch('pushy.tasks.get_instrumentation',
+                        return_value=backend), \
+                mock.patch('pushy.dispatchers.GCMDispatcher.send_batch',
+                           new=gcm):
+            send_push_notification_chunk(
+                notification.to_dict(),
+                queued_at=1
+            )
+
+        self.assertEqual(
+            backend.counters,
+            {'gcm.sent': 2, 'gcm.invalid': 1, 'gcm.error': 0}
+        )
+        self.assertEqual(
+            sorted(backend.timings.keys()),
+            ['gcm.latency', 'group.bookkeeping', 'group.queue_wait',
+             'group.send']
+        )
@@ -1,6 +1,37 @@
+import datetime
+import time
+
+import mock
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.utils import IntegrityError
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from pushy.models import PushNotification
+from pushy.models import (
+    DeadLetter,
+    DeviceRecord,
+    PushDelivery,
+    PushDeliveryBuffer,
+    PushNotification,
+    PushNotificationTarget,
+    Device,
+    create_push_notification_targets,
+    purge_push_notifications,
+    purge_rows,
+    get_device_records,
+    get_devices_by_ids,
+    get_device_upsert_sql,
+    get_filtered_devices_queryset,
+    register_device,
+    register_devices,
+    unregister_devices,
+    update_devices_last_success,
+    update_devices_keys,
+    delete_devices
+)
 
 
 class TasksTestCase(TestCase):
@@ -20,3 +51,402 @@ class TasksTestCase(TestCase):
     def test_to_dict(self):
         notification = PushNotification()
         self.assertTrue('_state' not in notification.to_dict())
+
+
+class AudienceFiltersTestCase(TestCase):
+    def setUp(self):
+        self.devices = [
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_{}'.format(user_id),
+                type=device_type,
+                user_id=user_id
+            )
+            for user_id, device_type in [
+                (1, Device.DEVICE_TYPE_ANDROID),
+                (2, Device.DEVICE_TYPE_IOS),
+                (3, Device.DEVICE_TYPE_ANDROID),
+                (5, Device.DEVICE_TYPE_IOS),
+                (6, Device.DEVICE_TYPE_ANDROID),
+            ]
+        ]
+
+    def get_user_ids(self, notification):
+        devices = get_filtered_devices_queryset(notification.to_dict())
+        return sorted(devices.values_list('user_id', flat=True))
+
+    def test_device_types(self):
+        notification = PushNotification()
+        notification.device_types = [2, 1, 2]
+
+        self.assertEqual(notification.filter_types, '1,2')
+        self.assertEqual(notification.device_types, [1, 2])
+
+        notification.device_types = None
+        self.assertEqual(notification.device_types, [])
+
+    def test_filter_targets(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload={}
+        )
+        create_push_notification_targets(notification, [1, 2, 6, 7])
+
+        self.assertTrue(notification.filter_targets)
+        self.assertEqual(
+            list(notification.targets.order_by('user_id')
+                 .values_list('user_id', flat=True)),
+            [1, 2, 6, 7]
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_user_ids(notification), [1, 2, 6])
+
+    def test_filter_targets_query_plan(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload={}
+        )
+        create_push_notification_targets(notification, range(1, 1000, 7))
+        devices = get_filtered_devices_queryset(notification.to_dict())
+
+        # The targets are looked up once through their index,
+        # not once for every device
+        sql, params = devices.order_by('pk').query.sql_with_params()
+        subquery = sql.split(' IN (', 1)[1].split(')', 1)[0]
+        self.assertNotIn(Device._meta.db_table, subquery)
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = ' '.join(row[-1] for row in cursor.fetchall())
+            self.assertNotIn('CORRELATED', plan)
+            self.assertIn('USING COVERING INDEX', plan)
+
+    def test_filter_targets_and_types(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload={}
+        )
+        other = PushNotification.objects.create(title='other', payload={})
+        create_push_notification_targets(notification, [2, 3, 5])
+        create_push_notification_targets(other, [1, 6])
+
+        notification.device_types = [Device.DEVICE_TYPE_IOS]
+        self.assertEqual(self.get_user_ids(notification), [2, 5])
+
+        notification.device_types = [
+            Device.DEVICE_TYPE_IOS,
+            Device.DEVICE_TYPE_ANDROID
+        ]
+        self.assertEqual(self.get_user_ids(notification), [2, 3, 5])
+
+
+class DevicesBookkeepingTestCase(TestCase):
+    def create_devices(self, count, device_type=Device.DEVICE_TYPE_ANDROID):
+        return [
+            Device.objects.create(key='KEY_{}'.format(i), type=device_type)
+            for i in range(count)
+        ]
+
+    def test_update_devices_keys(self):
+        devices = self.create_devices(3)
+
+        with self.assertNumQueries(4):
+            # One lookup for existing keys and one update within a savepoint
+            redundant_ids = update_devices_keys([
+                (device.id, device.type, 'NEW_{}'.format(device.key))
+                for device in devices
+            ])
+
+        self.assertEqual(redundant_ids, [])
+        self.assertEqual(
+            sorted(Device.objects.values_list('key', flat=True)),
+            ['NEW_KEY_0', 'NEW_KEY_1', 'NEW_KEY_2']
+        )
+
+    def test_update_devices_keys_conflicts(self):
+        devices = self.create_devices(3)
+        Device.objects.create(key='KEY_0', type=Device.DEVICE_TYPE_IOS)
+
+        redundant_ids = update_devices_keys([
+            # Already registered
+            (devices[0].id, devices[0].type, 'KEY_1'),
+            # Only registered for another device type
+            (devices[1].id, devices[1].type, 'NEW_KEY'),
+            # Claimed by an earlier device in the same batch
+            (devices[2].id, devices[2].type, 'NEW_KEY')
+        ])
+
+        self.assertEqual(sorted(redundant_ids), [devices[0].id, devices[2].id])
+        self.assertEqual(Device.objects.get(pk=devices[1].id).key, 'NEW_KEY')
+        self.assertEqual(Device.objects.get(pk=devices[2].id).key, 'KEY_2')
+
+    def test_update_devices_keys_integrity_error_fallback(self):
+        devices = self.create_devices(2)
+
+        with mock.patch('pushy.models.Device.objects.filter') as filter_mock:
+            filter_mock.return_value.values_list.return_value = []
+            filter_mock.return_value.update.side_effect = [
+                IntegrityError, None, IntegrityError
+            ]
+            redundant_ids = update_devices_keys([
+                (devices[0].id, devices[0].type, 'NEW_KEY_0'),
+                (devices[1].id, devices[1].type, 'KEY_0')
+            ])
+
+        self.assertEqual(redundant_ids, [devices[1].id])
+
+    def test_delete_devices(self):
+        devices = self.create_devices(5)
+
+        delete_devices([device.id for device in devices[:3]])
+
+        self.assertEqual(
+            list(Device.objects.order_by('id').values_list('id', flat=True)),
+            [devices[3].id, devices[4].id]
+        )
+
+    def test_register_device(self):
+        user = get_user_model().objects.create_user('test_user')
+
+        with self.assertNumQueries(1):
+            register_device('NEW_KEY', Device.DEVICE_TYPE_ANDROID)
+        with self.assertNumQueries(1):
+            register_device('NEW_KEY', Device.DEVICE_TYPE_ANDROID, user.id)
+
+        device = Device.objects.get(key='NEW_KEY')
+        self.assertEqual(device.type, Device.DEVICE_TYPE_ANDROID)
+        self.assertEqual(device.user_id, user.id)
+
+    def test_device_upsert_sql_postgresql(self):
+        with mock.patch('pushy.models.connection',
+                        mock.Mock(vendor='postgresql', pg_version=90400,
+                                  ops=connection.ops)):
+            self.assertIsNone(get_device_upsert_sql())
+        with mock.patch('pushy.models.connection',
+                        mock.Mock(vendor='postgresql', pg_version=90500,
+                                  ops=connection.ops)):
+            self.assertIn('ON CONFLICT', get_device_upsert_sql())
+
+    def test_register_device_without_upsert(self):
+        user = get_user_model().objects.create_user('test_user')
+
+        with mock.patch('pushy.models.get_device_upsert_sql',
+                        return_value=None):
+            register_device('NEW_KEY', Device.DEVICE_TYPE_IOS)
+            register_device('NEW_KEY', Device.DEVICE_TYPE_IOS, user.id)
+            register_device('NEW_KEY', Device.DEVICE_TYPE_ANDROID)
+
+        self.assertEqual(
+            sorted(Device.objects.filter(key='NEW_KEY')
+                   .values_list('type', 'user_id')),
+            [(Device.DEVICE_TYPE_ANDROID, None),
+             (Device.DEVICE_TYPE_IOS, user.id)]
+        )
+
+    def test_register_devices(self):
+        Device.objects.create(key='KEY1', type=Device.DEVICE_TYPE_ANDROID)
+        user = get_user_model().objects.create_user('test_user')
+        devices = [('KEY1', Device.DEVICE_TYPE_ANDROID),
+                   ('KEY2', Device.DEVICE_TYPE_IOS),
+                   ('KEY2', Device.DEVICE_TYPE_IOS)]
+
+        with self.assertNumQueries(1):
+            register_devices(devices, user.id)
+        with mock.patch('pushy.models.get_device_upsert_sql',
+                        return_value=None):
+            register_devices(devices + [('KEY3', Device.DEVICE_TYPE_IOS)],
+                             user.id)
+
+        self.assertEqual(
+            sorted(Device.objects.values_list('key', 'type', 'user_id')),
+            [('KEY1', Device.DEVICE_TYPE_ANDROID, user.id),
+             ('KEY2', Device.DEVICE_TYPE_IOS, user.id),
+             ('KEY3', Device.DEVICE_TYPE_IOS, user.id)]
+        )
+
+    def test_register_devices_within_parameters_limit(self):
+        devices = [('KEY_{}'.format(i), Device.DEVICE_TYPE_IOS)
+                   for i in range(500)]
+
+        with CaptureQueriesContext(connection) as queries:
+            register_devices(devices)
+
+        self.assertEqual(Device.objects.count(), 500)
+        if get_device_upsert_sql():
+            # 4 parameters per row, at most 999 per statement
+            self.assertEqual(len(queries), 3)
+
+    def test_register_devices_last_registered(self):
+        device = Device.objects.create(
+            key='KEY1',
+            type=Device.DEVICE_TYPE_ANDROID,
+            last_registered=timezone.now() - datetime.timedelta(days=10)
+        )
+
+        register_devices([(device.key, device.type)])
+        device.refresh_from_db()
+        self.assertGreater(device.last_registered,
+                           timezone.now() - datetime.timedelta(minutes=1))
+
+        device.last_registered = timezone.now() - datetime.timedelta(days=10)
+        device.save()
+        with mock.patch('pushy.models.get_device_upsert_sql',
+                        return_value=None):
+            register_devices([(device.key, device.type)])
+        device.refresh_from_db()
+        self.assertGreater(device.last_registered,
+                           timezone.now() - datetime.timedelta(minutes=1))
+
+    def test_update_devices_last_success(self):
+        devices = self.create_devices(3)
+        recently = timezone.now() - datetime.timedelta(minutes=5)
+        Device.objects.filter(pk=devices[0].pk).update(last_success=recently)
+
+        update_devices_last_success(
+            [device.id for device in devices[:2]],
+            datetime.timedelta(hours=1)
+        )
+
+        for device in devices:
+            device.refresh_from_db()
+        # Recently reached devices are left as they are
+        self.assertEqual(devices[0].last_success, recently)
+        self.assertGreater(devices[1].last_success, recently)
+        self.assertIsNone(devices[2].last_success)
+
+    def test_unregister_devices(self):
+        devices = self.create_devices(2)
+
+        self.assertEqual(
+            unregister_devices([devices[0].key, 'UNKNOWN_KEY']),
+            set([devices[0].key])
+        )
+        self.assertEqual(list(Device.objects.all()), [devices[1]])
+
+    def test_get_device_records(self):
+        devices = [
+            Device.objects.create(key='KEY{}'.format(i),
+                                  type=Device.DEVICE_TYPE_ANDROID)
+            for i in range(3)
+        ]
+
+        with CaptureQueriesContext(connection) as queries:
+            records = list(get_device_records(
+                Device.objects.order_by('id')
+            ))
+
+        # Only the columns needed to send are fetched
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('user_id', queries[0]['sql'])
+
+        self.assertIsInstance(records[0], DeviceRecord)
+        self.assertFalse(hasattr(records[0], '__dict__'))
+        self.assertEqual(
+            [(record.id, record.key, record.type) for record in records],
+            [(device.id, device.key, device.type) for device in devices]
+        )
+        self.assertEqual(
+            [record.id for record in get_devices_by_ids(
+                [devices[2].id, devices[0].id]
+            )],
+            [devices[0].id, devices[2].id]
+        )
+
+
+class PushDeliveryBufferTestCase(TestCase):
+    def test_flush_every_size_rows(self):
+        deliveries = PushDeliveryBuffer(None, size=3)
+
+        with self.assertNumQueries(1):
+            for device_id in range(1, 5):
+                deliveries.add(device_id, PushDelivery.DELIVERY_SENT)
+        self.assertEqual(PushDelivery.objects.count(), 3)
+
+        with self.assertNumQueries(1):
+            deliveries.flush()
+        self.assertEqual(PushDelivery.objects.count(), 4)
+
+        with self.assertNumQueries(0):
+            deliveries.flush()
+
+    def test_flush_within_parameters_limit(self):
+        deliveries = PushDeliveryBuffer(None, size=2000)
+        for device_id in range(1, 1001):
+            deliveries.add(device_id, PushDelivery.DELIVERY_SENT)
+
+        with CaptureQueriesContext(connection) as queries:
+            deliveries.flush()
+
+        self.assertEqual(PushDelivery.objects.count(), 1000)
+        if connection.vendor == 'sqlite':
+            # 6 columns per row, at most 999 parameters per insert
+            self.assertEqual(len(queries), 7)
+
+    def test_deliveries_outlive_devices(self):
+        device = Device.objects.create(key='KEY', type=Device.DEVICE_TYPE_IOS)
+        deliveries = PushDeliveryBuffer(None)
+        deliveries.add(
+            device.id,
+            PushDelivery.DELIVERY_INVALID,
+            'PushInvalidTokenException'
+        )
+        deliveries.flush()
+
+        delete_devices([device.id])
+
+        self.assertEqual(
+            PushDelivery.objects.get().status,
+            PushDelivery.DELIVERY_INVALID
+        )
+
+
+class PurgeTestCase(TestCase):
+    def test_purge_rows(self):
+        for i in range(5):
+            Device.objects.create(key='KEY_{}'.format(i),
+                                  type=Device.DEVICE_TYPE_ANDROID)
+        devices = Device.objects.exclude(key='KEY_4')
+
+        # Nothing is deleted past the deadline
+        self.assertFalse(purge_rows(devices, 2, deadline=time.time() - 1))
+        self.assertEqual(Device.objects.count(), 5)
+
+        # Two batches of two rows and a last empty batch
+        with self.assertNumQueries(5):
+            self.assertTrue(purge_rows(devices, 2))
+        self.assertEqual(list(Device.objects.values_list('key', flat=True)),
+                         ['KEY_4'])
+
+    def test_purge_push_notifications(self):
+        device = Device.objects.create(key='KEY',
+                                       type=Device.DEVICE_TYPE_ANDROID)
+        notifications = [
+            PushNotification.objects.create(title='test {}'.format(i),
+                                            payload={})
+            for i in range(3)
+        ]
+        for notification in notifications:
+            create_push_notification_targets(notification, [1, 2])
+            DeadLetter.objects.create(notification=notification,
+                                      device=device, body='{}')
+            PushDelivery.objects.create(notification=notification,
+                                        device=device,
+                                        status=PushDelivery.DELIVERY_SENT)
+
+        self.assertTrue(purge_push_notifications(
+            PushNotification.objects.exclude(pk=notifications[2].pk),
+            batch_size=1
+        ))
+
+        self.assertEqual(list(PushNotification.objects.all()),
+                         [notifications[2]])
+        for model in (DeadLetter, PushDelivery):
+            self.assertEqual(
+                list(model.objects.values_list('notification_id', flat=True)),
+                [notifications[2].id]
+            )
+        self.assertEqual(
+            set(PushNotificationTarget.objects.values_list(
+                'notification_id', flat=True
+            )),
+            set([notifications[2].id])
+        )
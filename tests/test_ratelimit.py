@@ -0,0 +1,82 @@
+import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from pushy import dispatchers
+from pushy.ratelimit import RateLimiter, get_rate_limiter
+
+from .data import batch_response
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@override_settings(PUSHY_RATE_LIMITS={'gcm': 10, 'apns': 10})
+class RateLimiterTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.clock = FakeClock()
+        patcher = mock.patch('pushy.ratelimit.time', new=self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_acquire_within_rate(self):
+        rate_limiter = RateLimiter('test', 10)
+
+        self.assertEqual(rate_limiter.acquire(4), 0)
+        self.assertEqual(rate_limiter.acquire(6), 0)
+        self.assertEqual(self.clock.now, 1000.0)
+
+    def test_acquire_waits_for_next_window(self):
+        rate_limiter = RateLimiter('test', 10)
+        self.clock.now = 1000.25
+
+        rate_limiter.acquire(8)
+        waited = rate_limiter.acquire(5)
+
+        self.assertAlmostEqual(waited, 0.75)
+        self.assertAlmostEqual(self.clock.now, 1001.0)
+        # Only the part which didn't fit spilled over to the next window
+        self.assertEqual(cache.get(rate_limiter.window_key(1000)), 10)
+        self.assertEqual(cache.get(rate_limiter.window_key(1001)), 3)
+
+    def test_acquire_more_than_rate(self):
+        rate_limiter = RateLimiter('test', 10)
+
+        waited = rate_limiter.acquire(25)
+
+        self.assertAlmostEqual(waited, 2)
+        self.assertEqual(cache.get(rate_limiter.window_key(1002)), 5)
+
+    def test_limiters_are_shared(self):
+        # Two workers using the same credential share the same limit
+        first = get_rate_limiter('gcm', 'KEY')
+        second = get_rate_limiter('gcm', 'KEY')
+        other = get_rate_limiter('gcm', 'OTHER_KEY')
+
+        first.acquire(5)
+        self.assertEqual(second.acquire(5), 0)
+        self.assertEqual(other.acquire(10), 0)
+        self.assertGreater(second.acquire(1), 0)
+
+    def test_get_rate_limiter_not_configured(self):
+        with override_settings(PUSHY_RATE_LIMITS={}):
+            self.assertIsNone(get_rate_limiter('gcm', 'KEY'))
+
+    def test_dispatcher_throttled(self):
+        dispatcher = dispatchers.GCMDispatcher()
+        with mock.patch('pushjack.GCMClient.send') as request_mock:
+            request_mock.return_value = batch_response()
+            dispatcher.send_batch(['KEY{}'.format(i) for i in range(15)], {})
+
+        self.assertAlmostEqual(self.clock.now, 1001.0)
@@ -1,28 +1,48 @@
 import datetime
 import mock
 
+from collections import OrderedDict
+
 from django.contrib.auth import get_user_model
 from django.test import TestCase
 from django.test.utils import override_settings
 from django.utils import timezone
 
 from pushy.models import (
+    DeadLetter,
+    PushDelivery,
     PushNotification,
     Device,
-    get_filtered_devices_queryset
+    get_filtered_devices_queryset,
+    get_devices_id_ranges,
+    get_audience_size,
+    get_devices_in_range
 )
 
 from pushy.exceptions import (
+    PushAuthException,
     PushException,
-    PushInvalidTokenException
+    PushInvalidDataException,
+    PushInvalidTokenException,
+    PushServerException
 )
 
+from pushy.dispatchers import GCMDispatcher
 from pushy.tasks import (
     check_pending_push_notifications,
+    claim_push_notification,
+    send_push_notification_chunk,
     send_push_notification_group,
+    send_push_notification_devices,
     send_single_push_notification,
+    handle_push_notification_failures,
+    get_retry_delay,
     create_push_notification_groups,
+    create_push_notification_chunks,
+    get_notification_message,
+    resolve_notification,
     clean_sent_notifications,
+    prune_stale_devices,
     notify_push_notification_sent
 )
 
@@ -103,6 +123,84 @@ class TasksTestCase(TestCase):
 
         self.assertEqual(devices.count(), 0)
 
+    def test_get_devices_id_ranges(self):
+        devices = [
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_{}'.format(i),
+                type=Device.DEVICE_TYPE_ANDROID
+            )
+            for i in range(7)
+        ]
+        ids = [device.id for device in devices]
+
+        id_ranges = list(get_devices_id_ranges(Device.objects.all(), 3))
+        self.assertEqual(id_ranges, [
+            (0, ids[2]),
+            (ids[2], ids[5]),
+            (ids[5], ids[6])
+        ])
+
+        # Ranges cover every device exactly once
+        chunks = [
+            list(get_devices_in_range(Device.objects.all(), *id_range))
+            for id_range in id_ranges
+        ]
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+        self.assertEqual(
+            [device.id for chunk in chunks for device in chunk],
+            ids
+        )
+
+        # An exact multiple of the limit leaves no empty trailing chunk
+        id_ranges = list(get_devices_id_ranges(Device.objects.all(), 7))
+        self.assertEqual(id_ranges, [(0, ids[6])])
+
+        self.assertEqual(
+            list(get_devices_id_ranges(Device.objects.none(), 3)),
+            []
+        )
+
+    def test_get_audience_size(self):
+        for i in range(7):
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_{}'.format(i),
+                type=Device.DEVICE_TYPE_ANDROID
+            )
+        devices = Device.objects.all()
+        id_ranges = list(get_devices_id_ranges(devices, 3))
+
+        # Only the last chunk is counted
+        with self.assertNumQueries(1):
+            self.assertEqual(get_audience_size(devices, id_ranges, 3), 7)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                get_audience_size(devices, id_ranges, 3, exact=False),
+                9
+            )
+        self.assertEqual(get_audience_size(devices, [], 3), 0)
+
+    def test_devices_in_range_ignore_deleted_devices(self):
+        devices = [
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_{}'.format(i),
+                type=Device.DEVICE_TYPE_ANDROID
+            )
+            for i in range(6)
+        ]
+        id_ranges = list(get_devices_id_ranges(Device.objects.all(), 3))
+
+        # Deleting a device from the first chunk doesn't shift
+        # devices between chunks
+        devices[0].delete()
+        second_chunk = get_devices_in_range(
+            Device.objects.all(),
+            *id_ranges[1]
+        )
+        self.assertEqual(
+            [device.id for device in second_chunk],
+            [device.id for device in devices[3:]]
+        )
+
     def test_pending_notifications(self):
         PushNotification.objects.create(
             title='test',
@@ -118,7 +216,7 @@ class TasksTestCase(TestCase):
             check_pending_push_notifications()
             mocked_task.assert_called()
 
-    def test_notifications_groups_chord(self):
+    def test_pending_notifications_claimed_once(self):
         notification = PushNotification.objects.create(
             title='test',
             payload=self.payload,
@@ -126,18 +224,355 @@ class TasksTestCase(TestCase):
             sent=PushNotification.PUSH_NOT_SENT
         )
 
-        # Create a test device key
+        mocked_task = mock.Mock()
+        with mock.patch(
+                'pushy.tasks.create_push_notification_groups.apply_async',
+                new=mocked_task):
+            check_pending_push_notifications()
+            check_pending_push_notifications()
+
+        mocked_task.assert_called_once()
+        notification = PushNotification.objects.get(pk=notification.id)
+        self.assertEqual(notification.sent, PushNotification.PUSH_IN_PROGRESS)
+        self.assertIsNotNone(notification.date_started)
+        self.assertEqual(
+            mocked_task.call_args[1]['kwargs']['notification']['sent'],
+            PushNotification.PUSH_IN_PROGRESS
+        )
+
+    def test_pending_notifications_claimed_by_another_scheduler(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_NOT_SENT
+        )
+
+        # Another scheduler claims the notification first
+        self.assertTrue(claim_push_notification(notification))
+        notification.sent = PushNotification.PUSH_NOT_SENT
+        self.assertFalse(claim_push_notification(notification))
+
+    def test_pending_notifications_publish_failure(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_NOT_SENT
+        )
+
+        # The claim is given back so that the next sweep retries it
+        with mock.patch(
+                'pushy.tasks.create_push_notification_groups.apply_async',
+                side_effect=IOError):
+            self.assertRaises(IOError, check_pending_push_notifications)
+
+        notification.refresh_from_db()
+        self.assertEqual(notification.sent, PushNotification.PUSH_NOT_SENT)
+        self.assertIsNone(notification.date_started)
+
+    @override_settings(PUSHY_PENDING_BATCH_SIZE=2)
+    def test_pending_notifications_batch_size(self):
+        for i in range(3):
+            PushNotification.objects.create(
+                title='test {}'.format(i),
+                payload=self.payload,
+                active=PushNotification.PUSH_ACTIVE,
+                sent=PushNotification.PUSH_NOT_SENT
+            )
+
+        mocked_task = mock.Mock()
+        with mock.patch(
+                'pushy.tasks.create_push_notification_groups.apply_async',
+                new=mocked_task):
+            check_pending_push_notifications()
+            self.assertEqual(mocked_task.call_count, 2)
+
+            check_pending_push_notifications()
+            self.assertEqual(mocked_task.call_count, 3)
+
+    @override_settings(PUSHY_DEVICE_KEY_LIMIT=2, PUSHY_FANOUT_SIZE=2)
+    def test_notifications_groups_fan_out(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_NOT_SENT
+        )
+
+        devices = [
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_ANDROID_{}'.format(i),
+                type=Device.DEVICE_TYPE_ANDROID
+            )
+            for i in range(5)
+        ]
+
+        # One sub-coordinator per range of PUSHY_FANOUT_SIZE chunks
+        with mock.patch('pushy.tasks.create_push_notification_chunks'
+                        '.apply_async') as mocked_task:
+            create_push_notification_groups(notification.to_dict())
+
+        self.assertEqual(
+            [(call[1]['kwargs']['after_id'], call[1]['kwargs']['until_id'])
+             for call in mocked_task.call_args_list],
+            [(0, devices[3].id), (devices[3].id, devices[4].id)]
+        )
+        # Tasks don't carry the payload
+        self.assertEqual(
+            mocked_task.call_args[1]['kwargs']['notification'],
+            get_notification_message(notification.to_dict())
+        )
+        self.assertNotIn(
+            'payload',
+            mocked_task.call_args[1]['kwargs']['notification']
+        )
+        notification.refresh_from_db()
+        self.assertEqual(notification.remaining_groups, 2)
+        self.assertEqual(notification.sent, PushNotification.PUSH_IN_PROGRESS)
+
+    def test_notifications_groups_redelivered(self):
         Device.objects.create(
             key='TEST_DEVICE_KEY_ANDROID',
             type=Device.DEVICE_TYPE_ANDROID
         )
+        in_progress = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_IN_PROGRESS,
+            remaining_groups=2
+        )
+        sent = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_SENT
+        )
+
+        # Notifications already fanned out or sent aren't fanned out again
+        with mock.patch('pushy.tasks.create_push_notification_chunks'
+                        '.apply_async') as mocked_task:
+            create_push_notification_groups(in_progress.to_dict())
+            create_push_notification_groups(sent.to_dict())
+
+        mocked_task.assert_not_called()
+        in_progress.refresh_from_db()
+        self.assertEqual(in_progress.remaining_groups, 2)
+        sent.refresh_from_db()
+        self.assertEqual(sent.sent, PushNotification.PUSH_SENT)
+
+    @override_settings(PUSHY_DEVICE_KEY_LIMIT=2)
+    def test_create_push_notification_chunks(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_IN_PROGRESS,
+            audience_size=0,
+            remaining_groups=1
+        )
+
+        devices = [
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_ANDROID_{}'.format(i),
+                type=Device.DEVICE_TYPE_ANDROID
+            )
+            for i in range(5)
+        ]
 
         mocked_task = mock.Mock()
         with mock.patch(
-                'celery.chord',
+                'celery.group',
                 new=mocked_task):
+            create_push_notification_chunks(
+                notification.to_dict(),
+                devices[0].id,
+                devices[4].id
+            )
+            mocked_task.return_value.apply_async.assert_called_once_with()
+
+        self.assertEqual(
+            [signature.args[1:] for signature in mocked_task.call_args[0][0]],
+            [(devices[0].id, devices[2].id), (devices[2].id, devices[4].id)]
+        )
+
+        # The chunks took over the token of the sub-coordinator
+        notification.refresh_from_db()
+        self.assertEqual(notification.remaining_groups, 2)
+        self.assertEqual(notification.audience_size, 4)
+
+    @override_settings(PUSHY_DEVICE_KEY_LIMIT=2, PUSHY_FANOUT_SIZE=2)
+    def test_notifications_groups_audience_size(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_NOT_SENT
+        )
+        for i in range(5):
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_ANDROID_{}'.format(i),
+                type=Device.DEVICE_TYPE_ANDROID
+            )
+
+        def create_chunks(kwargs):
+            create_push_notification_chunks(**kwargs)
+
+        with mock.patch('pushy.tasks.create_push_notification_chunks'
+                        '.apply_async', side_effect=create_chunks), \
+                mock.patch('celery.group'):
             create_push_notification_groups(notification.to_dict())
-            mocked_task.assert_called()
+            notification.refresh_from_db()
+            self.assertEqual(notification.audience_size, 5)
+            self.assertEqual(notification.remaining_groups, 3)
+
+            PushNotification.objects.filter(pk=notification.pk).update(
+                remaining_groups=0
+            )
+            with override_settings(PUSHY_AUDIENCE_SIZE_EXACT=False):
+                create_push_notification_groups(notification.to_dict())
+            notification.refresh_from_db()
+            self.assertEqual(notification.audience_size, 6)
+
+    @override_settings(PUSHY_PAYLOAD_CACHE_SIZE=1)
+    def test_resolve_notification(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload
+        )
+        other_notification = PushNotification.objects.create(
+            title='other',
+            payload={'other': 'payload'}
+        )
+        message = get_notification_message(notification.to_dict())
+        other_message = get_notification_message(
+            other_notification.to_dict()
+        )
+
+        with mock.patch('pushy.tasks.payloads_cache', new=OrderedDict()):
+            with self.assertNumQueries(1):
+                self.assertEqual(
+                    resolve_notification(message)['payload'],
+                    self.payload
+                )
+                # Later chunks of the notification hit the cache
+                self.assertEqual(
+                    resolve_notification(message)['payload'],
+                    self.payload
+                )
+
+            # The cache is bounded
+            with self.assertNumQueries(2):
+                resolve_notification(other_message)
+                resolve_notification(message)
+
+        # Notifications which weren't stored are sent whole
+        notification_dict = notification.to_dict()
+        notification_dict['id'] = None
+        self.assertIs(
+            get_notification_message(notification_dict),
+            notification_dict
+        )
+        with self.assertNumQueries(0):
+            self.assertIs(
+                resolve_notification(notification_dict),
+                notification_dict
+            )
+
+        # Replayed dead letters only carry the notification id
+        with mock.patch('pushy.tasks.payloads_cache', new=OrderedDict()) \
+                as payloads_cache:
+            with self.assertNumQueries(1):
+                self.assertEqual(
+                    resolve_notification({'id': notification.id}),
+                    {'id': notification.id, 'payload': self.payload}
+                )
+            self.assertFalse(payloads_cache)
+
+    @mock.patch('pushy.tasks.logger.exception')
+    def test_send_notification_groups_deleted_notification(self,
+                                                           logging_mock):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            remaining_groups=1
+        )
+        message = get_notification_message(notification.to_dict())
+        notification.delete()
+
+        gcm = mock.Mock()
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch',
+                        new=gcm), \
+                mock.patch('pushy.tasks.payloads_cache', new=OrderedDict()):
+            self.assertFalse(send_push_notification_chunk(message))
+
+        self.assertFalse(gcm.called)
+        logging_mock.assert_called()
+
+    def test_notifications_groups_completion(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_IN_PROGRESS,
+            remaining_groups=2
+        )
+
+        message = get_notification_message(notification.to_dict())
+        gcm = mock.Mock(return_value=({}, {}))
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch', new=gcm):
+            send_push_notification_chunk(message)
+            notification.refresh_from_db()
+            self.assertEqual(notification.remaining_groups, 1)
+            self.assertEqual(
+                notification.sent,
+                PushNotification.PUSH_IN_PROGRESS
+            )
+
+            # The last group marks the notification as sent
+            send_push_notification_chunk(message)
+            notification.refresh_from_db()
+            self.assertEqual(notification.remaining_groups, 0)
+            self.assertEqual(notification.sent, PushNotification.PUSH_SENT)
+            self.assertIsNotNone(notification.date_finished)
+
+    def test_notifications_groups_completion_on_failure(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_IN_PROGRESS,
+            remaining_groups=1
+        )
+
+        with mock.patch('pushy.tasks.send_push_notification_to_devices',
+                        side_effect=ValueError):
+            self.assertRaises(
+                ValueError,
+                send_push_notification_chunk,
+                notification.to_dict()
+            )
+
+        notification.refresh_from_db()
+        self.assertEqual(notification.sent, PushNotification.PUSH_SENT)
+
+    def test_notifications_groups_no_devices(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_NOT_SENT
+        )
+
+        with mock.patch('pushy.tasks.create_push_notification_chunks'
+                        '.apply_async') as mocked_task:
+            create_push_notification_groups(notification.to_dict())
+
+        self.assertFalse(mocked_task.called)
+        notification.refresh_from_db()
+        self.assertEqual(notification.sent, PushNotification.PUSH_SENT)
+        self.assertEqual(notification.audience_size, 0)
 
     def test_notifications_groups_return(self):
         notification = PushNotification.objects.create(
@@ -155,7 +590,7 @@ class TasksTestCase(TestCase):
 
         mocked_task = mock.Mock()
         with mock.patch(
-                'celery.chord',
+                'pushy.tasks.create_push_notification_chunks.apply_async',
                 new=mocked_task):
             notification_dict = notification.to_dict()
             notification_dict['id'] = None
@@ -180,18 +615,20 @@ class TasksTestCase(TestCase):
 
         # Make sure canonical ID is saved
         gcm = mock.Mock()
-        gcm.return_value = 123123
-        with mock.patch('pushy.dispatchers.GCMDispatcher.send', new=gcm):
-            send_push_notification_group(notification.to_dict(), 0, 1)
+        gcm.return_value = ({device.key: 123123}, {})
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch', new=gcm):
+            send_push_notification_chunk(notification.to_dict())
 
+            self.assertEqual(gcm.call_args[0][0], [device.key])
+            self.assertEqual(gcm.call_args[0][1].payload, self.payload)
             device = Device.objects.get(pk=device.id)
             self.assertEqual(device.key, '123123')
 
         # Make sure the key is deleted when not registered exception is fired
         gcm = mock.Mock()
-        gcm.side_effect = PushInvalidTokenException
-        with mock.patch('pushy.dispatchers.GCMDispatcher.send', new=gcm):
-            send_push_notification_group(notification.to_dict(), 0, 1)
+        gcm.return_value = ({}, {device.key: PushInvalidTokenException()})
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch', new=gcm):
+            send_push_notification_chunk(notification.to_dict())
 
             self.assertRaises(
                 Device.DoesNotExist,
@@ -207,13 +644,390 @@ class TasksTestCase(TestCase):
 
         # No canonical ID wasn't returned
         gcm = mock.Mock()
-        gcm.return_value = False
-        with mock.patch('pushy.dispatchers.GCMDispatcher.send', new=gcm):
-            send_push_notification_group(notification.to_dict(), 0, 1)
+        gcm.return_value = ({}, {})
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch', new=gcm):
+            send_push_notification_chunk(notification.to_dict())
 
             device = Device.objects.get(pk=device.id)
             self.assertEqual(device.key, 'TEST_DEVICE_KEY_ANDROID2')
 
+    def test_send_notification_groups_legacy_offsets(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_IN_PROGRESS,
+            remaining_groups=0
+        )
+        devices = [
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_ANDROID_{}'.format(i),
+                type=Device.DEVICE_TYPE_ANDROID
+            )
+            for i in range(5)
+        ]
+
+        # Chord headers queued by previous versions carry an offset
+        # and a limit as positional arguments
+        gcm = mock.Mock(return_value=({}, {}))
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch', new=gcm):
+            send_push_notification_group(notification.to_dict(), 2, 2)
+
+        self.assertEqual(sorted(gcm.call_args[0][0]),
+                         [devices[2].key, devices[3].key])
+        # Completion is left to the chord's callback
+        notification.refresh_from_db()
+        self.assertEqual(notification.sent, PushNotification.PUSH_IN_PROGRESS)
+
+    def test_send_notification_groups_multicast(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_NOT_SENT
+        )
+
+        for i in range(5):
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_ANDROID_{}'.format(i),
+                type=Device.DEVICE_TYPE_ANDROID
+            )
+        for i in range(3):
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_IOS_{}'.format(i),
+                type=Device.DEVICE_TYPE_IOS
+            )
+
+        gcm = mock.Mock()
+        gcm.return_value = (
+            {'TEST_DEVICE_KEY_ANDROID_0': 'NEW_KEY'},
+            {
+                'TEST_DEVICE_KEY_ANDROID_1': PushInvalidTokenException(),
+                'TEST_DEVICE_KEY_ANDROID_2': PushServerException()
+            }
+        )
+        apns = mock.Mock()
+        apns.return_value = ({}, {})
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch',
+                        new=gcm), \
+                mock.patch('pushy.dispatchers.APNSDispatcher.send_batch',
+                           new=apns), \
+                mock.patch('pushy.tasks.send_push_notification_devices'
+                           '.apply_async') as retry_mock:
+            send_push_notification_chunk(notification.to_dict())
+
+        # One provider request per device type
+        self.assertEqual(gcm.call_count, 1)
+        self.assertEqual(len(gcm.call_args[0][0]), 5)
+        self.assertEqual(apns.call_count, 1)
+        self.assertEqual(len(apns.call_args[0][0]), 3)
+
+        self.assertTrue(Device.objects.filter(key='NEW_KEY').exists())
+        self.assertFalse(
+            Device.objects.filter(key='TEST_DEVICE_KEY_ANDROID_1').exists()
+        )
+        self.assertTrue(
+            Device.objects.filter(key='TEST_DEVICE_KEY_ANDROID_2').exists()
+        )
+        self.assertEqual(Device.objects.count(), 7)
+
+        # The device which failed on the server side is retried later
+        self.assertEqual(retry_mock.call_count, 1)
+        self.assertEqual(
+            retry_mock.call_args[1]['kwargs']['device_ids'],
+            [Device.objects.get(key='TEST_DEVICE_KEY_ANDROID_2').id]
+        )
+        self.assertEqual(retry_mock.call_args[1]['kwargs']['attempt'], 1)
+
+    @override_settings(PUSHY_DISPATCH_THREADS=4,
+                       PUSHY_DISPATCH_THREAD_BATCH_SIZE=2)
+    def test_send_notification_groups_threads(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_NOT_SENT
+        )
+        for i in range(5):
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_ANDROID_{}'.format(i),
+                type=Device.DEVICE_TYPE_ANDROID
+            )
+
+        def send_batch(device_keys, payload):
+            errors = {}
+            if 'TEST_DEVICE_KEY_ANDROID_3' in device_keys:
+                errors['TEST_DEVICE_KEY_ANDROID_3'] = \
+                    PushInvalidTokenException()
+            return {}, errors
+
+        gcm = mock.Mock(side_effect=send_batch)
+        prepare = mock.Mock(wraps=GCMDispatcher().prepare)
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch',
+                        new=gcm), \
+                mock.patch('pushy.dispatchers.GCMDispatcher.prepare',
+                           new=prepare):
+            send_push_notification_chunk(notification.to_dict())
+
+        # The payload is prepared once and shared by all threads
+        prepare.assert_called_once_with(self.payload)
+        self.assertEqual(
+            len(set(id(call[0][1]) for call in gcm.call_args_list)),
+            1
+        )
+
+        # Results from every thread are merged for the database writes
+        self.assertEqual(gcm.call_count, 3)
+        self.assertEqual(
+            sorted(len(call[0][0]) for call in gcm.call_args_list),
+            [1, 2, 2]
+        )
+        self.assertEqual(Device.objects.count(), 4)
+        self.assertFalse(
+            Device.objects.filter(key='TEST_DEVICE_KEY_ANDROID_3').exists()
+        )
+
+    @mock.patch('pushy.tasks.logger.exception')
+    def test_send_notification_groups_invalid_payload(self, logging_mock):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload={'message': 'x' * 2048},
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_NOT_SENT
+        )
+        Device.objects.create(
+            key='TEST_DEVICE_KEY_IOS',
+            type=Device.DEVICE_TYPE_IOS
+        )
+
+        apns = mock.Mock()
+        with mock.patch('pushy.dispatchers.APNSDispatcher.send_batch',
+                        new=apns):
+            send_push_notification_chunk(notification.to_dict())
+
+        self.assertFalse(apns.called)
+        logging_mock.assert_called()
+
+    @mock.patch('pushy.tasks.logger.exception')
+    def test_send_notification_groups_batch_exception(self, logging_mock):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_NOT_SENT
+        )
+        Device.objects.create(
+            key='TEST_DEVICE_KEY_ANDROID',
+            type=Device.DEVICE_TYPE_ANDROID
+        )
+
+        gcm = mock.Mock()
+        gcm.side_effect = PushAuthException
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch', new=gcm):
+            send_push_notification_chunk(notification.to_dict())
+
+        logging_mock.assert_called()
+        self.assertEqual(Device.objects.count(), 1)
+
+        # Errors which can't be fixed by retrying go to the dead letters
+        dead_letter = DeadLetter.objects.get()
+        self.assertEqual(dead_letter.notification_id, notification.id)
+        self.assertEqual(dead_letter.error, 'PushAuthException')
+        # The payload is loaded from the notification on replay
+        self.assertEqual(dead_letter.body, '')
+        self.assertEqual(dead_letter.attempts, 1)
+
+    @override_settings(PUSHY_DELIVERY_LOG=True,
+                       PUSHY_DELIVERY_LOG_BUFFER_SIZE=2)
+    def test_send_notification_groups_delivery_log(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_IN_PROGRESS
+        )
+        devices = [
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_ANDROID_{}'.format(i),
+                type=Device.DEVICE_TYPE_ANDROID
+            )
+            for i in range(3)
+        ]
+
+        gcm = mock.Mock(return_value=(
+            {},
+            {
+                devices[1].key: PushInvalidTokenException(),
+                devices[2].key: PushInvalidDataException()
+            }
+        ))
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch',
+                        new=gcm):
+            send_push_notification_chunk(notification.to_dict())
+
+        deliveries = dict(
+            (delivery.device_id, delivery)
+            for delivery in PushDelivery.objects.filter(
+                notification=notification
+            )
+        )
+        self.assertEqual(len(deliveries), 3)
+        self.assertEqual(
+            deliveries[devices[0].id].status,
+            PushDelivery.DELIVERY_SENT
+        )
+        self.assertIsNotNone(deliveries[devices[0].id].latency)
+        self.assertEqual(
+            deliveries[devices[1].id].status,
+            PushDelivery.DELIVERY_INVALID
+        )
+        self.assertEqual(
+            deliveries[devices[2].id].status,
+            PushDelivery.DELIVERY_FAILED
+        )
+        self.assertEqual(
+            deliveries[devices[2].id].error,
+            'PushInvalidDataException'
+        )
+
+    def test_send_notification_groups_delivery_log_disabled(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_IN_PROGRESS
+        )
+        Device.objects.create(
+            key='TEST_DEVICE_KEY_ANDROID',
+            type=Device.DEVICE_TYPE_ANDROID
+        )
+
+        gcm = mock.Mock(return_value=({}, {}))
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch',
+                        new=gcm):
+            send_push_notification_chunk(notification.to_dict())
+
+        self.assertFalse(PushDelivery.objects.exists())
+
+    def test_send_push_notification_devices(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_IN_PROGRESS
+        )
+        devices = [
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_ANDROID_{}'.format(i),
+                type=Device.DEVICE_TYPE_ANDROID
+            )
+            for i in range(3)
+        ]
+
+        gcm = mock.Mock(return_value=({}, {}))
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch', new=gcm):
+            send_push_notification_devices(
+                notification.to_dict(),
+                [devices[0].id, devices[2].id],
+                attempt=1
+            )
+
+        self.assertEqual(
+            sorted(gcm.call_args[0][0]),
+            [devices[0].key, devices[2].key]
+        )
+
+    def test_send_push_notification_devices_completion(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_IN_PROGRESS,
+            remaining_groups=2
+        )
+        device = Device.objects.create(
+            key='TEST_DEVICE_KEY_ANDROID',
+            type=Device.DEVICE_TYPE_ANDROID
+        )
+        message = get_notification_message(notification.to_dict())
+
+        gcm = mock.Mock(return_value=({}, {}))
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch', new=gcm):
+            # Retries don't count as groups of the notification
+            send_push_notification_devices(message, [device.id], attempt=1)
+            notification.refresh_from_db()
+            self.assertEqual(notification.remaining_groups, 2)
+
+            send_push_notification_devices(message, [device.id],
+                                           finish_group=True)
+            send_push_notification_devices(message, [device.id],
+                                           finish_group=True)
+
+        notification.refresh_from_db()
+        self.assertEqual(notification.remaining_groups, 0)
+        self.assertEqual(notification.sent, PushNotification.PUSH_SENT)
+
+    @override_settings(PUSHY_MAX_RETRIES=2)
+    def test_handle_failures_retries_exhausted(self):
+        device = Device.objects.create(
+            key='TEST_DEVICE_KEY_ANDROID',
+            type=Device.DEVICE_TYPE_ANDROID
+        )
+
+        with mock.patch('pushy.tasks.send_push_notification_devices'
+                        '.apply_async') as retry_mock:
+            handle_push_notification_failures(
+                {'id': None, 'payload': self.payload},
+                [(device.id, PushServerException())],
+                attempt=2
+            )
+
+        self.assertFalse(retry_mock.called)
+        dead_letter = DeadLetter.objects.get()
+        self.assertIsNone(dead_letter.notification_id)
+        self.assertEqual(dead_letter.error, 'PushServerException')
+        self.assertEqual(dead_letter.attempts, 3)
+
+    def test_handle_failures_retry_after(self):
+        device = Device.objects.create(
+            key='TEST_DEVICE_KEY_ANDROID',
+            type=Device.DEVICE_TYPE_ANDROID
+        )
+        other_device = Device.objects.create(
+            key='TEST_DEVICE_KEY_IOS',
+            type=Device.DEVICE_TYPE_IOS
+        )
+
+        with mock.patch('pushy.tasks.send_push_notification_devices'
+                        '.apply_async') as retry_mock:
+            handle_push_notification_failures(
+                {'id': None, 'payload': self.payload},
+                [
+                    (device.id, PushServerException(retry_after=600)),
+                    (other_device.id, PushInvalidDataException())
+                ]
+            )
+
+        self.assertEqual(
+            retry_mock.call_args[1]['kwargs']['device_ids'],
+            [device.id]
+        )
+        self.assertGreaterEqual(retry_mock.call_args[1]['countdown'], 600)
+        self.assertEqual(
+            DeadLetter.objects.get().device_id,
+            other_device.id
+        )
+
+    @override_settings(PUSHY_RETRY_BASE_DELAY=10, PUSHY_RETRY_MAX_DELAY=60)
+    def test_get_retry_delay(self):
+        for attempt, (low, high) in enumerate([(5, 10), (10, 20), (20, 40),
+                                               (30, 60), (30, 60)]):
+            delay = get_retry_delay(attempt)
+            self.assertGreaterEqual(delay, low)
+            self.assertLessEqual(delay, high)
+
+        self.assertEqual(get_retry_delay(0, retry_after=100), 100)
+
     def test_delete_old_key_if_canonical_is_registered(self):
         notification = PushNotification.objects.create(
             title='test',
@@ -231,9 +1045,9 @@ class TasksTestCase(TestCase):
         # Make sure old device is deleted
         # if the new canonical ID already exists
         gcm = mock.Mock()
-        gcm.return_value = '123123'
-        with mock.patch('pushy.dispatchers.GCMDispatcher.send', new=gcm):
-            send_push_notification_group(notification.to_dict(), 0, 1)
+        gcm.return_value = ({device.key: '123123'}, {})
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch', new=gcm):
+            send_push_notification_chunk(notification.to_dict())
 
             self.assertFalse(Device.objects.filter(pk=device.id).exists())
 
@@ -275,6 +1089,8 @@ class TasksTestCase(TestCase):
 
             logging_mock.assert_called()
 
+        self.assertEqual(DeadLetter.objects.get().device_id, device.id)
+
     def test_delete_old_notifications_undefine_max_age(self):
         self.assertRaises(ValueError, clean_sent_notifications)
 
@@ -323,6 +1139,106 @@ class TasksTestCase(TestCase):
 
         self.assertEquals(PushNotification.objects.count(), 10)
 
+    @override_settings(PUSHY_NOTIFICATION_MAX_AGE=datetime.timedelta(days=90))
+    def test_delete_old_notifications_delivery_log(self):
+        date_finished = timezone.now() - datetime.timedelta(days=91)
+        old_notification = PushNotification.objects.create(
+            title='old',
+            payload=self.payload,
+            sent=PushNotification.PUSH_SENT,
+            date_finished=date_finished
+        )
+        notification = PushNotification.objects.create(
+            title='recent',
+            payload=self.payload,
+            sent=PushNotification.PUSH_SENT,
+            date_finished=timezone.now()
+        )
+        for delivery_notification in [old_notification, notification, None]:
+            PushDelivery.objects.create(
+                notification=delivery_notification,
+                device_id=1,
+                status=PushDelivery.DELIVERY_SENT
+            )
+        PushDelivery.objects.filter(notification=None).update(
+            date_created=date_finished
+        )
+
+        clean_sent_notifications()
+
+        self.assertEqual(
+            list(PushDelivery.objects.values_list(
+                'notification_id', flat=True
+            )),
+            [notification.id]
+        )
+
+    def test_send_notification_groups_last_success(self):
+        notification = PushNotification.objects.create(
+            title='test',
+            payload=self.payload,
+            active=PushNotification.PUSH_ACTIVE,
+            sent=PushNotification.PUSH_IN_PROGRESS
+        )
+        devices = [
+            Device.objects.create(
+                key='TEST_DEVICE_KEY_ANDROID_{}'.format(i),
+                type=Device.DEVICE_TYPE_ANDROID
+            )
+            for i in range(3)
+        ]
+
+        gcm = mock.Mock(return_value=(
+            {},
+            {devices[1].key: PushServerException()}
+        ))
+        with mock.patch('pushy.dispatchers.GCMDispatcher.send_batch',
+                        new=gcm), \
+                mock.patch('pushy.tasks.send_push_notification_devices'
+                           '.apply_async'):
+            send_push_notification_chunk(notification.to_dict())
+
+        self.assertEqual(
+            [device.last_success is not None
+             for device in Device.objects.order_by('id')],
+            [True, False, True]
+        )
+
+    def test_prune_stale_devices_undefined_max_idle(self):
+        self.assertRaises(ValueError, prune_stale_devices)
+
+    @override_settings(PUSHY_DEVICE_MAX_IDLE=datetime.timedelta(days=30),
+                       PUSHY_PURGE_BATCH_SIZE=1)
+    def test_prune_stale_devices(self):
+        old_date = timezone.now() - datetime.timedelta(days=31)
+        notification = PushNotification.objects.create(title='test',
+                                                       payload=self.payload)
+        devices = {}
+        for name, last_registered, last_success in [
+                ('registered', timezone.now(), None),
+                ('reached', old_date, timezone.now()),
+                ('stale', old_date, old_date),
+                ('never_reached', old_date, None)]:
+            devices[name] = Device.objects.create(
+                key=name,
+                type=Device.DEVICE_TYPE_ANDROID,
+                last_registered=last_registered,
+                last_success=last_success
+            )
+            DeadLetter.objects.create(notification=notification,
+                                      device=devices[name], body='{}')
+
+        self.assertTrue(prune_stale_devices())
+
+        self.assertEqual(
+            sorted(Device.objects.values_list('key', flat=True)),
+            ['reached', 'registered']
+        )
+        self.assertEqual(
+            sorted(DeadLetter.objects.values_list('device__key', flat=True)),
+            ['reached', 'registered']
+        )
+
     def test_notify_notification_finished(self):
         notification = PushNotification.objects.create(
             title='test',